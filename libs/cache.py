@@ -0,0 +1,130 @@
+import os
+import re
+import json
+import shutil
+import typing
+import hashlib
+import logging
+import tempfile
+
+from datetime import tzinfo
+
+from .calls import CallManager
+from .type import FilePath, DirPath
+from .messages import MessageStore
+from .contacts import ContactManager
+
+# Increase it whenever the format of the snapshots changes, so old snapshots are rebuilt
+CACHE_SCHEMA_VERSION = 2
+HASH_CHUNK_SIZE = 1024 * 1024
+TEMP_DIR_PREFIX = '.tmp-'
+SNAPSHOT_DIR_REGEXP = re.compile(r'v\d+-[0-9a-f]{64}')
+
+
+class MsgstoreCache:
+    """
+    Snapshots of the messages, calls and contacts parsed from msgstore.db files, stored as .npy columns.
+    A snapshot is reused while the database file keeps the same size, modification time and content. The
+    content is only hashed when no snapshot of the same file, size and modification time is found.
+    """
+    def __init__(self, cache_dir: DirPath):
+        self.cache_dir: DirPath = cache_dir
+        self._snapshots: typing.Dict[typing.Tuple[FilePath, int, int], DirPath] = dict()
+
+    def get_message_store(self, db_path: FilePath, tz: tzinfo=None) -> MessageStore:
+        snapshot_dir = self._get_snapshot(db_path)
+        return MessageStore.load(os.path.join(snapshot_dir, 'messages'), tz=tz)
+
+    def get_call_manager(self, db_path: FilePath, tz: tzinfo=None) -> CallManager:
+        snapshot_dir = self._get_snapshot(db_path)
+        return CallManager.load(os.path.join(snapshot_dir, 'calls'), tz=tz)
+
+    def get_contact_manager(self, db_path: FilePath) -> ContactManager:
+        snapshot_dir = self._get_snapshot(db_path)
+        with open(os.path.join(snapshot_dir, 'contacts.json'), encoding='utf-8') as file:
+            contacts = json.load(file)
+        contact_manager = ContactManager()
+        for jid in contacts:
+            contact_manager.add_contact(jid, None)
+        return contact_manager
+
+    def _get_snapshot(self, db_path: FilePath) -> DirPath:
+        stat = os.stat(db_path)
+        key = os.path.abspath(db_path), stat.st_size, stat.st_mtime_ns
+        if key not in self._snapshots:
+            self._snapshots[key] = self._create_snapshot(db_path, stat)
+        return self._snapshots[key]
+
+    def _create_snapshot(self, db_path: FilePath, stat: os.stat_result) -> DirPath:
+        snapshot_dir = self._find_snapshot(os.path.abspath(db_path), stat)
+        if snapshot_dir:
+            return snapshot_dir
+
+        content_hash = get_file_hash(db_path)
+        snapshot_dir = os.path.join(self.cache_dir, f'v{CACHE_SCHEMA_VERSION}-{content_hash}')
+        metadata = self._read_metadata(snapshot_dir)
+        if metadata and metadata['size'] == stat.st_size and metadata['mtime'] == stat.st_mtime_ns:
+            return snapshot_dir
+
+        logging.info(f'Caching "{db_path}"...')
+        os.makedirs(self.cache_dir, exist_ok=True)
+        temp_dir = tempfile.mkdtemp(prefix=TEMP_DIR_PREFIX, dir=self.cache_dir)
+        try:
+            MessageStore.from_msgstore_db(db_path).save(os.path.join(temp_dir, 'messages'))
+            CallManager.from_calls(CallManager.iter_calls(db_path)).save(os.path.join(temp_dir, 'calls'))
+            with open(os.path.join(temp_dir, 'contacts.json'), 'w', encoding='utf-8') as file:
+                json.dump([contact.jid for contact in ContactManager.from_msgtore_db(db_path)], file)
+            with open(os.path.join(temp_dir, 'metadata.json'), 'w', encoding='utf-8') as file:
+                json.dump({'version': CACHE_SCHEMA_VERSION, 'source': os.path.abspath(db_path),
+                           'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': content_hash}, file)
+            shutil.rmtree(snapshot_dir, ignore_errors=True)
+            os.replace(temp_dir, snapshot_dir)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+        self._remove_stale_snapshots(os.path.abspath(db_path), snapshot_dir)
+        return snapshot_dir
+
+    def _find_snapshot(self, source: FilePath, stat: os.stat_result) -> typing.Optional[DirPath]:
+        """
+        Snapshot of the source file with its size and modification time, None when there is not exactly one
+        """
+        if not os.path.isdir(self.cache_dir):
+            return None
+        snapshot_dirs = []
+        for entry in os.listdir(self.cache_dir):
+            snapshot_dir = os.path.join(self.cache_dir, entry)
+            if not SNAPSHOT_DIR_REGEXP.fullmatch(entry):
+                continue
+            metadata = self._read_metadata(snapshot_dir)
+            if metadata and metadata['source'] == source and metadata['size'] == stat.st_size \
+                    and metadata['mtime'] == stat.st_mtime_ns:
+                snapshot_dirs.append(snapshot_dir)
+        return snapshot_dirs[0] if len(snapshot_dirs) == 1 else None
+
+    def _remove_stale_snapshots(self, source: FilePath, current_snapshot_dir: DirPath):
+        for entry in os.listdir(self.cache_dir):
+            snapshot_dir = os.path.join(self.cache_dir, entry)
+            if snapshot_dir == current_snapshot_dir or not SNAPSHOT_DIR_REGEXP.fullmatch(entry):
+                continue
+            metadata = self._read_metadata(snapshot_dir)
+            if metadata is None or metadata['source'] == source:
+                logging.debug(f'Removing stale cache "{snapshot_dir}"')
+                shutil.rmtree(snapshot_dir, ignore_errors=True)
+
+    @staticmethod
+    def _read_metadata(snapshot_dir: DirPath) -> typing.Optional[dict]:
+        try:
+            with open(os.path.join(snapshot_dir, 'metadata.json'), encoding='utf-8') as file:
+                metadata = json.load(file)
+        except (OSError, ValueError):
+            return None
+        return metadata if metadata.get('version') == CACHE_SCHEMA_VERSION else None
+
+
+def get_file_hash(file_path: FilePath) -> str:
+    hash_ = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            hash_.update(chunk)
+    return hash_.hexdigest()
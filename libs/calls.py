@@ -1,7 +1,18 @@
-import sqlite3
+import os
+import sys
+import json
+
+import numpy as np
 
 from datetime import datetime
 
+from .database import connect_read_only, fetch_rows, FETCH_BATCH_SIZE
+
+MSGSTORE_CALLS_SQL = 'SELECT jid.raw_string, call_log.from_me, call_log.timestamp, call_log.video_call, call_log.duration, call_log.call_result, call_log._id FROM call_log ' \
+                     'INNER JOIN jid ON call_log.jid_row_id = jid._id '
+MSGSTORE_CALLS_ROW_ID_RANGE_CONDITION = 'WHERE call_log._id > ? AND call_log._id <= ? '
+MSGSTORE_CALLS_FILTER_COLUMNS = ('call_log.timestamp', 'jid.raw_string')
+
 
 class CallManager:
     def __init__(self):
@@ -15,26 +26,103 @@ class CallManager:
     
     @staticmethod
     def from_msgstore_db(db_path, tz=None):
-        with sqlite3.connect(db_path) as conn:
+        with connect_read_only(db_path) as conn:
             call_manager = CallManager()
-            for row in conn.execute('SELECT jid.raw_string, call_log.from_me, call_log.timestamp, call_log.video_call, call_log.duration, call_log.call_result FROM call_log ' \
-                                    'INNER JOIN jid ON call_log.jid_row_id = jid._id'):
-                remote_jid, from_me, timestamp, video_call, duration, call_result = row
+            for row in conn.execute(MSGSTORE_CALLS_SQL):
+                remote_jid, from_me, timestamp, video_call, duration, call_result, _ = row
                 call = Call(remote_jid, from_me, timestamp / 1000, video_call, duration, call_result, tz=tz)
                 if remote_jid not in call_manager._calls:
                     call_manager._calls[remote_jid] = []
                 call_manager._calls[remote_jid].append(call)
         return call_manager
 
+    @staticmethod
+    def from_calls(calls):
+        call_manager = CallManager()
+        for call in calls:
+            call_manager._calls.setdefault(call.remote_jid, [])
+            call_manager._calls[call.remote_jid].append(call)
+        return call_manager
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        calls = list(self)
+        jids = list(self._calls.keys())
+        jid_codes = {jid: code for code, jid in enumerate(jids)}
+        columns = {
+            'jid_codes': np.array([jid_codes[call.remote_jid] for call in calls], dtype=np.int32),
+            'from_me': np.array([call.from_me for call in calls], dtype=bool),
+            'timestamps': np.array([call.timestamp for call in calls], dtype=np.int64),
+            'video_call': np.array([call.is_video_call for call in calls], dtype=bool),
+            'durations': np.array([call.duration for call in calls], dtype=np.int64),
+            'results': np.array([call.result for call in calls], dtype=np.int64)
+        }
+        for column, values in columns.items():
+            np.save(os.path.join(directory, f'{column}.npy'), values)
+        with open(os.path.join(directory, 'jids.json'), 'w', encoding='utf-8') as file:
+            json.dump(jids, file)
+
+    @staticmethod
+    def load(directory, tz=None):
+        columns = [np.load(os.path.join(directory, f'{column}.npy')).tolist() for column in CallManager._COLUMNS]
+        with open(os.path.join(directory, 'jids.json'), encoding='utf-8') as file:
+            jids = json.load(file)
+        call_manager = CallManager()
+        for code, from_me, timestamp, video_call, duration, result in zip(*columns):
+            remote_jid = jids[code]
+            call = Call(remote_jid, from_me, timestamp / 1000, video_call, duration, result, tz=tz)
+            call_manager._calls.setdefault(remote_jid, [])
+            call_manager._calls[remote_jid].append(call)
+        return call_manager
+
+    _COLUMNS = ('jid_codes', 'from_me', 'timestamps', 'video_call', 'durations', 'results')
+
+    @staticmethod
+    def iter_calls(db_path, tz=None, batch_size=FETCH_BATCH_SIZE, after_row_id=0, last_row_id=None,
+                   msgstore_filter=None, offset=0):
+        if last_row_id is None:
+            last_row_id = CallManager.get_last_row_id(db_path)
+        with connect_read_only(db_path) as conn:
+            sql = MSGSTORE_CALLS_SQL + MSGSTORE_CALLS_ROW_ID_RANGE_CONDITION
+            parameters = [after_row_id, last_row_id]
+            if msgstore_filter:
+                filter_condition, filter_parameters = msgstore_filter.get_sql_condition(*MSGSTORE_CALLS_FILTER_COLUMNS)
+                if filter_condition:
+                    sql += f'AND {filter_condition} '
+                    parameters += filter_parameters
+            cursor = conn.execute(sql + 'ORDER BY call_log.timestamp, call_log._id LIMIT -1 OFFSET ?', parameters + [offset])
+            for row in fetch_rows(cursor, batch_size):
+                remote_jid, from_me, timestamp, video_call, duration, call_result, _ = row
+                yield Call(remote_jid, from_me, timestamp / 1000, video_call, duration, call_result, tz=tz)
+
+    @staticmethod
+    def get_last_row_id(db_path):
+        with connect_read_only(db_path) as conn:
+            return conn.execute('SELECT MAX(_id) FROM call_log').fetchone()[0] or 0
+
 
 class Call:
+    __slots__ = ('remote_jid', 'from_me', 'timestamp', 'is_video_call', 'duration', 'result', 'tz', '_date')
+
     def __init__(self, remote_jid, from_me, date, video_call, duration, result, tz=None):
-        self.remote_jid = remote_jid
+        self.remote_jid = sys.intern(remote_jid) if isinstance(remote_jid, str) else remote_jid
         self.from_me = bool(from_me)
-        self.date = datetime.fromtimestamp(date, tz=tz) if not isinstance(date, datetime) else date
         self.is_video_call = bool(video_call)
         self.duration = duration
         self.result = result
+        self.tz = tz
+        if isinstance(date, datetime):
+            self.timestamp = round(date.timestamp() * 1000)
+            self._date = date
+        else:
+            self.timestamp = round(date * 1000)
+            self._date = None
+
+    @property
+    def date(self):
+        if self._date is None:
+            self._date = datetime.fromtimestamp(self.timestamp / 1000, tz=self.tz)
+        return self._date
 
     def __repr__(self):
         return f'{self.__class__.__name__}{(self.remote_jid, self.from_me, self.date, self.is_video_call, self.duration, self.result)}'
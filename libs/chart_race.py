@@ -15,7 +15,7 @@ import dataclasses
 import numpy as np
 
 from . import utils
-from .messages import Message
+from .messages import Message, MessageStore
 from .type import Jid, FilePath
 from .contacts import Contact, ContactManager, JID_REGEXP
 
@@ -511,11 +511,11 @@ def generate_video_frames(messages: typing.Iterable[Message], start_date: dateti
     group_message_range_timedelta = datetime.timedelta(days=7 * ANIMATION_SMOOTHNESS)
     animation_state = AnimationState(current_date=start_date, frame_step_timedelta=frame_step_timedelta,
                                      group_message_range_timedelta=group_message_range_timedelta)
-    next_step_date: datetime.datetime = animation_state.current_date + group_message_range_timedelta
+    next_step_timestamp: float = (animation_state.current_date + group_message_range_timedelta).timestamp() * 1000
     frames_by_group: int = group_message_range_timedelta // frame_step_timedelta
     user_total_messages: typing.Dict[Jid, int] = dict()
     for message in messages:
-        if message.date < next_step_date:
+        if message.timestamp < next_step_timestamp:
             user_total_messages.setdefault(message.remote_jid, 0)
             user_total_messages[message.remote_jid] += 1
         else:
@@ -536,7 +536,7 @@ def generate_video_frames(messages: typing.Iterable[Message], start_date: dateti
                 animation_state.current_frame += 1
                 animation_state.current_date += frame_step_timedelta
 
-            next_step_date = animation_state.current_date + group_message_range_timedelta
+            next_step_timestamp = (animation_state.current_date + group_message_range_timedelta).timestamp() * 1000
             user_total_messages = dict()
 
     # TODO: Last messages aren't being included
@@ -546,11 +546,13 @@ def generate_video_frames(messages: typing.Iterable[Message], start_date: dateti
             yield frame_image
 
 
-def create_chart_race_video(contact_manager: ContactManager, messages: typing.List[Message],
+def create_chart_race_video(contact_manager: ContactManager,
+                            messages: typing.Union[typing.List[Message], MessageStore],
                             output: FilePath, locale_='en_US.UTF-8'):
-    logging.info('Sorting messages by date...')
-    messages.sort(key=lambda message: message.date)
-    logging.info('Messages sorted!')
+    if not isinstance(messages, MessageStore):
+        logging.info('Sorting messages by date...')
+        messages.sort(key=lambda message: message.timestamp)
+        logging.info('Messages sorted!')
 
     logging.info('Rendering profile images...')
     profile_images = dict()
@@ -2,19 +2,25 @@ import os
 import re
 import base64
 import typing
-import sqlite3
 import vobject
 import logging
+import functools
 import itertools
 
+from enum import IntEnum
+
 from . import utils
+from .database import connect_read_only, Database
 from .type import Jid, Base64Image, FilePath, DirPath
-from .export_chats import parse_export_chat_file, EXPORT_CHAT_FILE_NAME
+from .export_chats import parse_export_chat_files, ExportChatMessage, EXPORT_CHAT_FILE_NAME
 
 vobject.vcard.wacky_apple_photo_serialize = False
 
 USER_JID_SUFFIX = 's.whatsapp.net'
 JID_REGEXP = re.compile(r'((\d+)(-(\d+))?)@(s.whatsapp.net|g.us)')
+# Phone numbers are matched with or without a country code of up to this length, shorter numbers must match fully
+COUNTRY_CODE_MAX_LENGTH = 3
+NATIONAL_NUMBER_MIN_LENGTH = 7
 
 TContactManager = typing.TypeVar('TContactManager', bound='ContactManager')
 
@@ -59,6 +65,76 @@ class Contact:
         return bool(Contact.GROUP_REGEXP.match(jid))
 
 
+class JidType(IntEnum):
+    OTHER = 0
+    USER = 1
+    GROUP = 2
+    BROADCAST = 3
+    TEMP = 4
+
+
+@functools.lru_cache(maxsize=None)
+def get_jid_type(jid: Jid) -> JidType:
+    """
+    Classify a jid, the result is cached so each distinct jid is only matched once
+    """
+    if jid is None:
+        return JidType.OTHER
+    elif jid.endswith('@broadcast'):
+        return JidType.BROADCAST
+    elif jid.endswith('@temp'):
+        return JidType.TEMP
+    elif Contact.is_group(jid):
+        return JidType.GROUP
+    elif Contact.is_user(jid):
+        return JidType.USER
+    return JidType.OTHER
+
+
+def normalize_phone_number(jid: Jid) -> str:
+    """
+    Digits of the phone number of a user jid, without the international (00) or trunk (0) prefixes
+    """
+    return re.sub(r'\D', '', jid.split('@', 1)[0]).lstrip('0')
+
+
+def join_contacts(contacts: typing.Iterable[Contact],
+                  other_contacts: typing.Iterable[Contact]) -> typing.Dict[Jid, Contact]:
+    """
+    Match user contacts with the first other contact of the same phone number, the other contacts may lack the
+    country code or have an international or trunk prefix. Contacts without such match fall back to the first other
+    contact with a similar jid.
+
+    :return: The matched other contact by jid of the contacts
+    """
+    other_contacts = list(other_contacts)
+    phone_numbers: typing.Dict[str, Contact] = dict()
+    for other_contact in other_contacts:
+        phone_numbers.setdefault(normalize_phone_number(other_contact.jid), other_contact)
+
+    matches = dict()
+    unmatched_contacts = []
+    for contact in contacts:
+        phone_number = normalize_phone_number(contact.jid)
+        national_numbers = (phone_number[i:] for i in range(1, COUNTRY_CODE_MAX_LENGTH + 1)
+                            if len(phone_number) - i >= NATIONAL_NUMBER_MIN_LENGTH)
+        for key in itertools.chain((phone_number,), national_numbers):
+            if key and key in phone_numbers:
+                matches[contact.jid] = phone_numbers[key]
+                break
+        else:
+            unmatched_contacts.append(contact)
+
+    if unmatched_contacts:
+        jid_index = utils.SimilarityIndex(c.jid for c in other_contacts)
+        for contact in unmatched_contacts:
+            for position in jid_index.get_candidates(contact.jid):
+                if utils.string_similarity(other_contacts[position].jid, contact.jid) >= utils.SIMILARITY_THRESHOLD:
+                    matches[contact.jid] = other_contacts[position]
+                    break
+    return matches
+
+
 class ContactManager:
     def __init__(self):
         self._users: typing.Dict[Jid, Contact] = dict()
@@ -145,29 +221,49 @@ class ContactManager:
                 self_contact.profile_image = other_contact.profile_image
 
         if by_display_name_similarity or by_jid_similarity:
+            # Only the candidates of the similarity indexes are compared, in the order of the other ContactManager
+            other_contacts = list(other_contact_manager)
+            jid_index = utils.SimilarityIndex(c.jid for c in other_contacts) if by_jid_similarity else None
+            name_index = utils.SimilarityIndex(c.display_name for c in other_contacts) if by_display_name_similarity else None
             for self_contact in self:
-                for other_contact in other_contact_manager:
-                    similar_jid = by_jid_similarity and utils.string_similarity(self_contact.jid, other_contact.jid) >= 0.95
-                    similar_name = by_display_name_similarity and self_contact.display_name and other_contact.display_name and \
-                        utils.string_similarity(self_contact.display_name, other_contact.display_name) >= 0.95
-
-                    if similar_jid or similar_name:
-                        if overwrite_display_name or (overwrite_display_name is None and self_contact.display_name is None):
-                            self.update_contact_diplay_name(self_contact.jid, other_contact.display_name)
-                        if overwrite_profile_image or (overwrite_profile_image is None and self_contact.profile_image is None):
-                            self_contact.profile_image = other_contact.profile_image
+                jid_candidates = jid_index.get_candidates(self_contact.jid) if jid_index else []
+                last_position = -1
+                while True:
+                    display_name = self_contact.display_name
+                    candidates = set(jid_candidates)
+                    if name_index:
+                        candidates.update(name_index.get_candidates(display_name))
+                    for position in sorted(p for p in candidates if p > last_position):
+                        last_position = position
+                        other_contact = other_contacts[position]
+                        similar_jid = by_jid_similarity and \
+                            utils.string_similarity(self_contact.jid, other_contact.jid) >= utils.SIMILARITY_THRESHOLD
+                        similar_name = by_display_name_similarity and self_contact.display_name and other_contact.display_name and \
+                            utils.string_similarity(self_contact.display_name, other_contact.display_name) >= utils.SIMILARITY_THRESHOLD
+
+                        if similar_jid or similar_name:
+                            if overwrite_display_name or (overwrite_display_name is None and self_contact.display_name is None):
+                                self.update_contact_diplay_name(self_contact.jid, other_contact.display_name)
+                            if overwrite_profile_image or (overwrite_profile_image is None and self_contact.profile_image is None):
+                                self_contact.profile_image = other_contact.profile_image
+                        if self_contact.display_name != display_name:
+                            # The display name changed, so the remaining candidates by display name are different
+                            break
+                    else:
+                        break
 
 
     def _get_jid_dictionary(self, jid: Jid) -> typing.Dict[str, Contact]:
-        if Contact.is_user(jid):
+        jid_type = get_jid_type(jid)
+        if jid_type == JidType.USER:
             return self._users
-        elif Contact.is_group(jid):
+        elif jid_type == JidType.GROUP:
             return self._groups
         raise ValueError(f'contact {jid} not found')
 
     @staticmethod
-    def from_wa_db(db_path: FilePath) -> TContactManager:
-        with sqlite3.connect(db_path) as conn:
+    def from_wa_db(db_path: Database) -> TContactManager:
+        with connect_read_only(db_path) as conn:
             contact_manager = ContactManager()
             for row in conn.execute('SELECT * FROM wa_contacts'):
                 jid = row[1]
@@ -177,8 +273,8 @@ class ContactManager:
         return contact_manager
 
     @staticmethod
-    def from_msgtore_db(db_path: FilePath, from_me: bool=True) -> TContactManager:
-        with sqlite3.connect(db_path) as conn:
+    def from_msgtore_db(db_path: Database, from_me: bool=True) -> TContactManager:
+        with connect_read_only(db_path) as conn:
             contact_manager = ContactManager()
 
             where_condition = ''
@@ -218,21 +314,21 @@ class ContactManager:
         return contact_manager
 
     @staticmethod
-    def from_export_chats_folder(chats_folder: DirPath) -> TContactManager:
+    def from_export_chats_folder(chats_folder: DirPath, workers: int=1) -> TContactManager:
         contact_manager = ContactManager()
 
-        chat_files = [file for file in os.listdir(chats_folder) if EXPORT_CHAT_FILE_NAME.match(file)]
-        for chat_file in chat_files:
-            chat_file = os.path.join(chats_folder, chat_file)
-
-            messages = parse_export_chat_file(chat_file)
-
-            for message in messages:
-                if message.dummy_jid not in contact_manager:
-                    contact_manager.add_contact(message.dummy_jid, message.contact_name)
+        chat_files = sorted(file for file in os.listdir(chats_folder) if EXPORT_CHAT_FILE_NAME.match(file))
+        chat_files = [os.path.join(chats_folder, file) for file in chat_files]
+        for messages in parse_export_chat_files(chat_files, workers=workers):
+            contact_manager.add_export_chat_contacts(messages)
 
         return contact_manager
 
+    def add_export_chat_contacts(self, messages: typing.Iterable[ExportChatMessage]):
+        for message in messages:
+            if message.dummy_jid not in self:
+                self.add_contact(message.dummy_jid, message.contact_name)
+
 
 if __name__ == '__main__':
     contact_manager = ContactManager.from_wa_db('wa.db')
@@ -0,0 +1,213 @@
+import os
+import glob
+import typing
+import pathlib
+import sqlite3
+import hashlib
+import logging
+import tempfile
+import contextlib
+
+import numpy as np
+
+from datetime import datetime
+
+FETCH_BATCH_SIZE = 10000
+
+# Pragmas of the read-only connections, the databases are read through memory-mapped I/O
+MMAP_SIZE = 1024 * 1024 * 1024
+CACHE_SIZE_KIB = 64 * 1024
+
+# Columns of msgstore.db looked up when joining the tables, each one should be the row id or the first column of an index
+MSGSTORE_JOIN_COLUMNS = (
+    ('message', 'chat_row_id'),
+    ('message_media', 'message_row_id'),
+    ('message_forwarded', 'message_row_id'),
+    ('message_quoted', 'message_row_id'),
+    ('chat', 'jid_row_id'),
+    ('call_log', 'jid_row_id')
+)
+SIDECAR_INDEX_PREFIX = 'sidecar_index'
+GROUP_JID_SUFFIX = '@g.us'
+
+# Path of a database file or an open connection to it
+Database = typing.Union[str, sqlite3.Connection]
+
+
+def fetch_rows(cursor: sqlite3.Cursor, batch_size: int=FETCH_BATCH_SIZE) -> typing.Iterator[tuple]:
+    rows = cursor.fetchmany(batch_size)
+    while rows:
+        yield from rows
+        rows = cursor.fetchmany(batch_size)
+
+
+@contextlib.contextmanager
+def connect_read_only(db_path: Database, immutable: bool=True) -> typing.Iterator[sqlite3.Connection]:
+    """
+    Open a database without ever writing in its file, the connection is closed at the end of the context.
+    An open connection, such as an in-memory database, is used as it is and kept open.
+
+    :param immutable: If true SQLite will not lock nor check the file for changes made by other processes
+    """
+    if isinstance(db_path, sqlite3.Connection):
+        yield db_path
+        return
+    uri = pathlib.Path(os.path.abspath(db_path)).as_uri() + '?mode=ro'
+    if immutable:
+        uri += '&immutable=1'
+    conn = sqlite3.connect(uri, uri=True)
+    try:
+        conn.execute(f'PRAGMA mmap_size = {MMAP_SIZE}')
+        conn.execute(f'PRAGMA cache_size = -{CACHE_SIZE_KIB}')
+        yield conn
+    finally:
+        conn.close()
+
+
+def get_missing_join_indexes(conn: sqlite3.Connection) -> typing.List[typing.Tuple[str, str]]:
+    """
+    Join columns of msgstore.db that are neither the row id nor the first column of an index
+    """
+    missing_indexes = []
+    for table, column in MSGSTORE_JOIN_COLUMNS:
+        table_info = conn.execute(f'PRAGMA table_info({table})').fetchall()
+        if not any(name == column for _, name, *_ in table_info):
+            continue
+        primary_keys = [(name, type_) for _, name, type_, _, _, pk in table_info if pk]
+        if primary_keys == [(column, 'INTEGER')]:
+            continue
+        indexed_columns = set()
+        for _, index_name, *_ in conn.execute(f'PRAGMA index_list({table})'):
+            index_columns = conn.execute(f'PRAGMA index_info("{index_name}")').fetchall()
+            if index_columns:
+                indexed_columns.add(index_columns[0][2])
+        if column not in indexed_columns:
+            missing_indexes.append((table, column))
+    return missing_indexes
+
+
+def create_join_indexes(conn: sqlite3.Connection, indexes: typing.List[typing.Tuple[str, str]]):
+    for table, column in indexes:
+        conn.execute(f'CREATE INDEX {SIDECAR_INDEX_PREFIX}_{table}_{column} ON {table} ({column})')
+    conn.commit()
+
+
+def get_indexed_database(db_path: Database, directory: str=None) -> Database:
+    """
+    Get the path of a copy of msgstore.db with the join indexes it lacks, the original file is never modified.
+    The copy is created once in the directory (by default the temporary one) and reused while the source is unchanged,
+    the copies of previous versions of the source are removed then. If no index is missing the source path itself is
+    returned. The indexes of an open connection, such as an in-memory database, are created in the connection itself.
+    """
+    with connect_read_only(db_path) as conn:
+        missing_indexes = get_missing_join_indexes(conn)
+    if not missing_indexes:
+        return db_path
+
+    if isinstance(db_path, sqlite3.Connection):
+        create_join_indexes(db_path, missing_indexes)
+        return db_path
+
+    stat = os.stat(db_path)
+    source_hash = hashlib.sha1(os.path.abspath(db_path).encode()).hexdigest()[:16]
+    version_hash = hashlib.sha1(f'{stat.st_size}:{stat.st_mtime_ns}'.encode()).hexdigest()[:16]
+    file_name, extension = os.path.splitext(os.path.basename(db_path))
+    directory = directory or tempfile.gettempdir()
+    sidecar_prefix = os.path.join(directory, f'{file_name}.{source_hash}.')
+    sidecar_path = f'{sidecar_prefix}{version_hash}.indexed{extension}'
+    if os.path.isfile(sidecar_path):
+        return sidecar_path
+
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix=extension)
+    os.close(fd)
+    try:
+        with connect_read_only(db_path) as source_conn:
+            sidecar_conn = sqlite3.connect(temp_path)
+            try:
+                source_conn.backup(sidecar_conn)
+                create_join_indexes(sidecar_conn, missing_indexes)
+            finally:
+                sidecar_conn.close()
+        os.replace(temp_path, sidecar_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    for stale_path in glob.glob(f'{glob.escape(sidecar_prefix)}*.indexed{glob.escape(extension)}'):
+        if stale_path != sidecar_path:
+            logging.debug(f'Removing stale indexed copy "{stale_path}"')
+            os.remove(stale_path)
+    return sidecar_path
+
+
+class MsgstoreFilter:
+    """
+    Date range and chats of the messages and calls read from msgstore.db
+    """
+    def __init__(self, since: datetime=None, until: datetime=None, jids: typing.Iterable[str]=None,
+                 exclude_groups: bool=False):
+        """
+        :param since: Read only what happened at or after it
+        :param until: Read only what happened before it
+        :param jids: Read only the chats of these jids
+        :param exclude_groups: If true the group chats will not be read
+        """
+        self.since: typing.Optional[datetime] = since
+        self.until: typing.Optional[datetime] = until
+        self.jids: typing.Optional[typing.FrozenSet[str]] = frozenset(jids) if jids else None
+        self.exclude_groups: bool = exclude_groups
+
+    @property
+    def since_timestamp(self) -> typing.Optional[int]:
+        return round(self.since.timestamp() * 1000) if self.since else None
+
+    @property
+    def until_timestamp(self) -> typing.Optional[int]:
+        return round(self.until.timestamp() * 1000) if self.until else None
+
+    def get_sql_condition(self, timestamp_column: str, jid_column: str) -> typing.Tuple[str, typing.List]:
+        """
+        SQL condition of the filter and its parameters, the condition is empty when nothing is filtered
+        """
+        conditions = []
+        parameters = []
+        if self.since:
+            conditions.append(f'COALESCE({timestamp_column}, 0) >= ?')
+            parameters.append(self.since_timestamp)
+        if self.until:
+            conditions.append(f'COALESCE({timestamp_column}, 0) < ?')
+            parameters.append(self.until_timestamp)
+        if self.jids is not None:
+            conditions.append(f'{jid_column} IN ({", ".join("?" * len(self.jids))})')
+            parameters.extend(sorted(self.jids))
+        if self.exclude_groups:
+            conditions.append(f"{jid_column} NOT GLOB '*{GROUP_JID_SUFFIX}'")
+        return ' AND '.join(conditions), parameters
+
+    def is_selected_jid(self, jid: str) -> bool:
+        if self.jids is None and not self.exclude_groups:
+            return True
+        return jid is not None and (self.jids is None or jid in self.jids) \
+            and not (self.exclude_groups and jid.endswith(GROUP_JID_SUFFIX))
+
+    def is_selected(self, jid: str, timestamp: int) -> bool:
+        """
+        Check if a message or call (timestamp in milliseconds) passes the filter
+        """
+        return (not self.since or timestamp >= self.since_timestamp) \
+            and (not self.until or timestamp < self.until_timestamp) and self.is_selected_jid(jid)
+
+    def get_mask(self, message_store) -> np.ndarray:
+        """
+        Boolean mask of the rows of a MessageStore that pass the filter
+        """
+        mask = np.ones(len(message_store), dtype=bool)
+        if self.since:
+            mask &= message_store.timestamps >= self.since_timestamp
+        if self.until:
+            mask &= message_store.timestamps < self.until_timestamp
+        if message_store.jids:
+            selected_codes = np.array([self.is_selected_jid(jid) for jid in message_store.jids], dtype=bool)
+            mask &= selected_codes[message_store.jid_codes]
+        return mask
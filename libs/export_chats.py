@@ -1,7 +1,9 @@
 import re
 import typing
 import datetime
+import functools
 import dataclasses
+import concurrent.futures
 
 from .type import FilePath
 
@@ -20,29 +22,90 @@ class ExportChatMessage:
     media_message: bool = False
 
 
-def parse_export_chat_file(filepath: FilePath, tz: datetime.tzinfo=None) -> typing.List[ExportChatMessage]:
-    message_headers = []
-    messages = []
-    with open(filepath, encoding='utf-8') as file:
-        messages_raw = file.read()
+class ExportChatDateParser:
+    """
+    Parse the dates of the messages headers of an export chat file. The date format (PT-BR or EN-US) is
+    detected once per file, and the dates are cached by minute since many messages share the same minute.
+    """
+    def __init__(self, date_format: str, tz: datetime.tzinfo=None):
+        if date_format not in (PT_BR_DATE_FORMAT, EN_US_DATE_FORMAT):
+            raise ValueError(f'unsupported date format "{date_format}"')
+        self.date_format: str = date_format
+        self.tz: datetime.tzinfo = tz
+        self._dates: typing.Dict[typing.Tuple[str, str], datetime.datetime] = dict()
 
-    for match in CHAT_MESSAGE_PATTERN.finditer(messages_raw):
-        message_headers.append(match)
+    def parse(self, date: str, time: str) -> datetime.datetime:
+        key = date, time
+        if key not in self._dates:
+            first, second, year = date.split('/')
+            day, month = (first, second) if self.date_format == PT_BR_DATE_FORMAT else (second, first)
+            year = int(year)
+            if self.date_format == EN_US_DATE_FORMAT:
+                # Same pivot year of strptime's %y
+                year += 2000 if year < 69 else 1900
+            hour, minute = time.split(':')
+            self._dates[key] = datetime.datetime(year, int(month), int(day), int(hour), int(minute), tzinfo=self.tz)
+        return self._dates[key]
 
-    for i, header in enumerate(message_headers):
+    @staticmethod
+    def from_header(header: re.Match, tz: datetime.tzinfo=None) -> 'ExportChatDateParser':
         date_format = PT_BR_DATE_FORMAT if len(header.group('year')) == 4 else EN_US_DATE_FORMAT
-        date = f'{header.group("date")} {header.group("time")}'
-        date = datetime.datetime.strptime(date, date_format)
-        if tz:
-            date = date.replace(tzinfo=tz)
-        contact_name = header.group('contact_name').strip()
-        start_index = header.start('message')
-        end_index = message_headers[i + 1].start() if i + 1 < len(message_headers) else len(messages_raw) 
-        message_data = messages_raw[start_index:end_index].strip()
-        media_message = bool(EXPORT_CHAT_MEDIA_MESSAGE.match(message_data))
-        dummy_jid = re.sub(r'[. ]', '_', contact_name).lower() + '@s.whatsapp.net'
-        message = ExportChatMessage(message_data, contact_name, date, dummy_jid, media_message)
-        
-        messages.append(message)
-
-    return messages
+        return ExportChatDateParser(date_format, tz)
+
+
+def iter_export_chat_file(filepath: FilePath, tz: datetime.tzinfo=None) -> typing.Iterator[ExportChatMessage]:
+    """
+    Stream the messages of an export chat file, reading it line by line. The lines that don't start a message
+    belong to the body of the previous message.
+    """
+    header = None
+    message_lines = []
+    date_parser = None
+    with open(filepath, encoding='utf-8') as file:
+        for line in file:
+            match = CHAT_MESSAGE_PATTERN.match(line)
+            if match:
+                if header:
+                    yield _create_export_chat_message(header, message_lines, date_parser)
+                else:
+                    date_parser = ExportChatDateParser.from_header(match, tz)
+                header = match
+                message_lines = [line[match.start('message'):]]
+            elif header:
+                message_lines.append(line)
+    if header:
+        yield _create_export_chat_message(header, message_lines, date_parser)
+
+
+def parse_export_chat_file(filepath: FilePath, tz: datetime.tzinfo=None) -> typing.List[ExportChatMessage]:
+    return list(iter_export_chat_file(filepath, tz))
+
+
+def _create_export_chat_message(header: re.Match, message_lines: typing.List[str],
+                                date_parser: ExportChatDateParser) -> ExportChatMessage:
+    date = date_parser.parse(header.group('date'), header.group('time'))
+    contact_name = header.group('contact_name').strip()
+    message_data = ''.join(message_lines).strip()
+    media_message = bool(EXPORT_CHAT_MEDIA_MESSAGE.match(message_data))
+    return ExportChatMessage(message_data, contact_name, date, get_dummy_jid(contact_name), media_message)
+
+
+@functools.lru_cache(maxsize=None)
+def get_dummy_jid(contact_name: str) -> str:
+    return re.sub(r'[. ]', '_', contact_name).lower() + '@s.whatsapp.net'
+
+
+def parse_export_chat_files(filepaths: typing.Iterable[FilePath], tz: datetime.tzinfo=None,
+                            workers: int=1) -> typing.Iterator[typing.List[ExportChatMessage]]:
+    """
+    Parse export chat files, yielding the messages of each file in the same order of the files
+
+    :param workers: Amount of processes parsing the files at the same time
+    """
+    parse = functools.partial(parse_export_chat_file, tz=tz)
+    if workers <= 1:
+        yield from map(parse, filepaths)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(parse, filepaths)
@@ -1,26 +1,350 @@
+import os
+import heapq
+import pickle
+import struct
+import tempfile
+import concurrent.futures
+
+import numpy as np
+
 from datetime import datetime
 from datetime import timedelta
 
-from .calls import Call
-from .messages import Message
-from .contacts import Contact
+from .calls import Call, CallManager
+from .messages import Message, MessageStore, MessageManager, MediaCategory, MSGSTORE_MESSAGES_FIELDS
+from .contacts import JidType, get_jid_type
+from .database import connect_read_only
 from .utils import time_delta_to_str
 
+# Header of the state files saved by InsighterManager, followed by the version of their layout and the pickled state
+STATE_FILE_MAGIC = b'WAINSIGHTS-STATE'
+STATE_FILE_VERSION = 4
+STATE_FILE_VERSION_FORMAT = '<H'
+# Amount of messages or calls applied between the checkpoints of InsighterManager.update_from_msgstore_db
+CHECKPOINT_INTERVAL = 100000
+
+# Sources for the SQL plans of the insighters. The temporary table insighter_jid is filled by InsighterManager and
+# maps the jid of each chat to the jid its messages and calls are accounted to (NULL when they are ignored), along
+# with the time range (in milliseconds) of the messages and calls read
+MESSAGE_PLAN_SOURCE = 'FROM message INNER JOIN chat ON message.chat_row_id = chat._id ' \
+                      'INNER JOIN jid ON chat.jid_row_id = jid._id ' \
+                      'INNER JOIN temp.insighter_jid ON jid.raw_string = insighter_jid.raw_string ' \
+                      'AND insighter_jid.message_jid IS NOT NULL ' \
+                      'AND COALESCE(message.timestamp, 0) >= insighter_jid.since_timestamp ' \
+                      'AND COALESCE(message.timestamp, 0) < insighter_jid.until_timestamp ' \
+                      'LEFT JOIN message_media ON message._id = message_media.message_row_id ' \
+                      'LEFT JOIN message_forwarded ON message._id = message_forwarded.message_row_id '
+CALL_PLAN_SOURCE = 'FROM call_log INNER JOIN jid ON call_log.jid_row_id = jid._id ' \
+                   'INNER JOIN temp.insighter_jid ON jid.raw_string = insighter_jid.raw_string ' \
+                   'AND insighter_jid.call_jid IS NOT NULL ' \
+                   'AND COALESCE(call_log.timestamp, 0) >= insighter_jid.since_timestamp ' \
+                   'AND COALESCE(call_log.timestamp, 0) < insighter_jid.until_timestamp '
+VOICE_MESSAGE_PLAN_CONDITION = "message.from_me = 0 AND message_media.mime_type GLOB 'audio/ogg; codecs=opus*' " \
+                               "AND message_media.media_duration != 0 " \
+                               "AND COALESCE(message_forwarded.forward_score, 0) = 0 "
+IMAGE_MESSAGE_PLAN_CONDITION = "message.from_me = 0 AND message_media.mime_type GLOB 'image/*' "
+OPUS_MEDIA_NAME_PLAN_CONDITION = "AND message_media.media_name GLOB '*.opus' "
+STATUS_ANSWER_CONDITION = "message.from_me = 0 AND message_quoted.from_me != 0 " \
+                          "AND quoted_jid.raw_string = 'status@broadcast' "
+# Rank items are created in the order the jids are found when streaming the messages and calls, which is the order
+# of the timestamp (NULL first) and row id of the first row of each jid
+MESSAGE_PLAN_FIRST_ROW_WINDOW = 'OVER (PARTITION BY insighter_jid.message_jid ORDER BY message.timestamp, message._id)'
+MESSAGE_PLAN_FIRST_ROW_COLUMNS = f'FIRST_VALUE(message.timestamp) {MESSAGE_PLAN_FIRST_ROW_WINDOW} AS first_timestamp, ' \
+                                 f'FIRST_VALUE(message._id) {MESSAGE_PLAN_FIRST_ROW_WINDOW} AS first_row_id'
+CALL_PLAN_FIRST_ROW_WINDOW = 'OVER (PARTITION BY insighter_jid.call_jid ORDER BY call_log.timestamp, call_log._id)'
+CALL_PLAN_FIRST_ROW_COLUMNS = f'FIRST_VALUE(call_log.timestamp) {CALL_PLAN_FIRST_ROW_WINDOW} AS first_timestamp, ' \
+                              f'FIRST_VALUE(call_log._id) {CALL_PLAN_FIRST_ROW_WINDOW} AS first_row_id'
+PLAN_ORDER = 'ORDER BY first_timestamp, first_row_id'
+PLAN_GROUP_ORDER = 'ORDER BY MIN(first_timestamp), MIN(first_row_id)'
+DAY_SLOT_MILLISECONDS = 15 * 60 * 1000
+MIN_PLAN_TIMESTAMP = -2 ** 63
+MAX_PLAN_TIMESTAMP = 2 ** 63 - 1
+
+
+def _get_codes_in_order(codes, indexes):
+    """
+    Distinct codes in the order they first appear, along with the index of their first appearance
+    """
+    _, first_positions = np.unique(codes, return_index=True)
+    first_positions = np.sort(first_positions)
+    return zip(codes[first_positions].tolist(), indexes[first_positions].tolist())
+
+
+def _get_first_of_groups(codes, values):
+    """
+    First value of each run of equal codes, the codes are expected to be grouped
+    """
+    if not len(codes):
+        return [], []
+    starts = np.r_[True, codes[1:] != codes[:-1]]
+    return codes[starts].tolist(), values[starts].tolist()
+
+
+def _get_store_message(message_store, jids, jid_codes, index):
+    message = message_store[int(index)]
+    message.remote_jid = jids[jid_codes[index]]
+    return message
+
+
+# MessageStore and row assignment shared with the processes of InsighterManager.update_messages
+_worker_message_shards = None
+
+
+def _set_worker_message_shards(message_store, jids, jid_codes, row_shards):
+    global _worker_message_shards
+    _worker_message_shards = message_store, jids, jid_codes, row_shards
+
+
+def _update_message_shard(insighters, shard):
+    """
+    Update copies of the insighters with the rows of a shard, the rank positions are translated to the rows of the
+    whole store. Return the insighters and whether each one has been updated.
+    """
+    message_store, jids, jid_codes, row_shards = _worker_message_shards
+    mask = row_shards == shard
+    rows = np.flatnonzero(mask)
+    shard_store = message_store.select(mask)
+    shard_jid_codes = jid_codes[mask]
+    updated = []
+    for insighter in insighters:
+        insighter._rank_positions = dict()
+        updated.append(insighter.update_batch(shard_store, jids, shard_jid_codes))
+        insighter._rank_positions = {jid: int(rows[position]) for jid, position in insighter._rank_positions.items()}
+    return insighters, updated
+
+
+def _get_voice_message_mask(message_store, check_media_name):
+    mask = ((message_store.flags & (MessageStore.FROM_ME | MessageStore.FORWARDED)) == 0) \
+        & (message_store.media_categories == MediaCategory.VOICE) & (message_store.media_durations != 0)
+    if check_media_name:
+        mask = message_store.media_name_mask('.opus', mask)
+    return mask
+
 
 class InsighterManager:
     def __init__(self, contact_manager, include_group=False, group_by_name=False):
         self._insighters = []
+        self._sql_insighters = set()
         self._group_by_name = group_by_name
         self._include_group = include_group
         self.contact_manager = contact_manager
+        self.last_message_row_id = 0
+        self.last_call_row_id = 0
+        # Last row id of an interrupted update and the amount of its messages (or calls) already applied
+        self.message_progress = None
+        self.call_progress = None
+        # Jid each chat jid is accounted to (None when it is ignored), resolved once per jid
+        self._message_jids = dict()
+        self._call_jids = dict()
+        # Jid of the contact whose data is accounted to other contacts with the same display name
+        self._jid_aliases = dict()
+        # Insighters of each type that still have to receive the data
+        self._pending_insighters = dict()
+        self.update_contacts()
+        self._update_pending_insighters()
     
     @property
     def insighters(self):
         return list(self._insighters)
 
+    def apply_sql_plans(self, db_path, msgstore_filter=None):
+        """
+        Compute in msgstore.db the insighters that provide a SQL plan. These insighters will ignore the
+        messages and calls given to the manager afterwards.
+
+        :param msgstore_filter: Date range and chats of the messages and calls accounted
+        """
+        since_timestamp = msgstore_filter and msgstore_filter.since_timestamp
+        until_timestamp = msgstore_filter and msgstore_filter.until_timestamp
+        since_timestamp = MIN_PLAN_TIMESTAMP if since_timestamp is None else since_timestamp
+        until_timestamp = MAX_PLAN_TIMESTAMP if until_timestamp is None else until_timestamp
+        with connect_read_only(db_path) as conn:
+            conn.execute('CREATE TEMP TABLE insighter_jid (raw_string TEXT PRIMARY KEY, message_jid TEXT, call_jid TEXT, '
+                         'since_timestamp INTEGER, until_timestamp INTEGER)')
+            jids = (jid for jid, in conn.execute('SELECT DISTINCT raw_string FROM jid WHERE raw_string IS NOT NULL')
+                    if not msgstore_filter or msgstore_filter.is_selected_jid(jid))
+            conn.executemany('INSERT INTO temp.insighter_jid VALUES (?, ?, ?, ?, ?)',
+                             ((jid, self._get_message_jid(jid), self._get_call_jid(jid), since_timestamp, until_timestamp)
+                              for jid in jids))
+            for insighter in self._insighters:
+                sql_plan = insighter.get_sql_plan()
+                if sql_plan and insighter not in self._sql_insighters:
+                    for row in conn.execute(sql_plan):
+                        insighter.handle_sql_row(row)
+                    self._sql_insighters.add(insighter)
+            conn.execute('DROP TABLE temp.insighter_jid')
+        self._update_pending_insighters()
+
+    def update_from_msgstore_db(self, db_path, tz=None, msgstore_filter=None, checkpoint_file=None,
+                                checkpoint_interval=CHECKPOINT_INTERVAL):
+        """
+        Apply in the insighters the messages and calls of msgstore.db added after the last ones applied
+
+        :param msgstore_filter: Date range and chats of the messages and calls applied
+        :param checkpoint_file: File where the state is saved every checkpoint_interval messages or calls applied,
+            once loaded from it an interrupted update resumes from the last checkpoint
+        """
+        last_message_row_id = MessageManager.get_last_row_id(db_path)
+        last_call_row_id = CallManager.get_last_row_id(db_path)
+
+        if self.has_pending_insighters(MessageInsighter):
+            for after_row_id, last_row_id, offset in self._get_update_ranges(self.last_message_row_id,
+                                                                              self.message_progress,
+                                                                              last_message_row_id):
+                messages = MessageManager.iter_messages(db_path, tz, after_row_id=after_row_id, last_row_id=last_row_id,
+                                                        fields=self.get_message_fields(),
+                                                        condition=self.get_message_condition(),
+                                                        msgstore_filter=msgstore_filter, offset=offset)
+                self.update_messages(self._iter_with_checkpoints(messages, 'message_progress', last_row_id, offset,
+                                                                 checkpoint_file, checkpoint_interval))
+                self.last_message_row_id = max(self.last_message_row_id, last_row_id)
+                self.message_progress = None
+        if self.has_pending_insighters(CallInsighter):
+            for after_row_id, last_row_id, offset in self._get_update_ranges(self.last_call_row_id, self.call_progress,
+                                                                              last_call_row_id):
+                calls = CallManager.iter_calls(db_path, tz, after_row_id=after_row_id, last_row_id=last_row_id,
+                                               msgstore_filter=msgstore_filter, offset=offset)
+                for call in self._iter_with_checkpoints(calls, 'call_progress', last_row_id, offset,
+                                                        checkpoint_file, checkpoint_interval):
+                    self._update_by_call(call)
+                self.last_call_row_id = max(self.last_call_row_id, last_row_id)
+                self.call_progress = None
+
+        self.last_message_row_id = max(self.last_message_row_id, last_message_row_id)
+        self.last_call_row_id = max(self.last_call_row_id, last_call_row_id)
+
+    @staticmethod
+    def _get_update_ranges(last_applied_row_id, progress, last_row_id):
+        """
+        Row id ranges still to be applied along with the amount of their rows already applied, the range of an
+        interrupted update comes first
+        """
+        ranges = []
+        if progress:
+            progress_row_id, applied = progress
+            ranges.append((last_applied_row_id, progress_row_id, applied))
+            last_applied_row_id = progress_row_id
+        if last_row_id > last_applied_row_id:
+            ranges.append((last_applied_row_id, last_row_id, 0))
+        return ranges
+
+    def _iter_with_checkpoints(self, items, progress_attribute, last_row_id, applied, checkpoint_file,
+                               checkpoint_interval):
+        """
+        Yield the messages or calls saving the state every checkpoint_interval of them, when an item is requested
+        all the previous ones have already been applied
+        """
+        unsaved = 0
+        for item in items:
+            if checkpoint_file and unsaved >= checkpoint_interval:
+                setattr(self, progress_attribute, (last_row_id, applied))
+                self.save_state(checkpoint_file)
+                unsaved = 0
+            yield item
+            applied += 1
+            unsaved += 1
+
+    def save_state(self, file_path):
+        """
+        Save the insighters and the last messages and calls applied in a file. The file is replaced at once, an
+        interruption while saving keeps the previous state.
+        """
+        state = {
+            'insighters': self._insighters,
+            'last_message_row_id': self.last_message_row_id,
+            'last_call_row_id': self.last_call_row_id,
+            'message_progress': self.message_progress,
+            'call_progress': self.call_progress,
+            'jid_aliases': self._jid_aliases
+        }
+        directory = os.path.dirname(os.path.abspath(file_path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(STATE_FILE_MAGIC + struct.pack(STATE_FILE_VERSION_FORMAT, STATE_FILE_VERSION))
+                pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, file_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def load_state(self, file_path):
+        """
+        Restore the insighters state saved by save_state. The state is only restored when it was saved with
+        the same state file version and the same insighters, in the same order, of this manager.
+
+        :return: True if the state has been restored
+        :raises ValueError: If the state was saved with other contacts grouped by name, its ranks are keyed by
+            other jids
+        """
+        version_size = struct.calcsize(STATE_FILE_VERSION_FORMAT)
+        with open(file_path, 'rb') as file:
+            header = file.read(len(STATE_FILE_MAGIC) + version_size)
+            if header[:len(STATE_FILE_MAGIC)] != STATE_FILE_MAGIC or len(header) != len(STATE_FILE_MAGIC) + version_size:
+                return False
+            version, = struct.unpack(STATE_FILE_VERSION_FORMAT, header[len(STATE_FILE_MAGIC):])
+            if version != STATE_FILE_VERSION:
+                return False
+            state = pickle.load(file)
+        insighters = state['insighters']
+        if [(i.__class__, i.title) for i in insighters] != [(i.__class__, i.title) for i in self._insighters]:
+            return False
+        if state['jid_aliases'] != self._jid_aliases:
+            raise ValueError('The insighters state was saved with other contacts grouped by display name')
+        self._insighters = insighters
+        self._sql_insighters = set()
+        self._update_pending_insighters()
+        self.last_message_row_id = state['last_message_row_id']
+        self.last_call_row_id = state['last_call_row_id']
+        self.message_progress = state['message_progress']
+        self.call_progress = state['call_progress']
+        return True
+
+    def get_message_fields(self):
+        """
+        Fields of the messages required by the insighters that still have to receive them
+        """
+        fields = set()
+        for insighter in self._filter_insighters(MessageInsighter):
+            fields |= insighter.get_required_fields()
+        return fields
+
+    def get_message_condition(self):
+        """
+        SQL condition of the messages required by the insighters that still have to receive them,
+        None when all messages are required
+        """
+        conditions = [insighter.get_row_condition() for insighter in self._filter_insighters(MessageInsighter)]
+        if not conditions or None in conditions:
+            return None
+        return ' OR '.join(f'({condition.strip()})' for condition in conditions)
+
+    def has_pending_insighters(self, class_):
+        """
+        Check if there are insighters of the class that still have to receive the data
+        """
+        return bool(self._filter_insighters(class_))
+
     def add_insighter(self, insighter):
         assert isinstance(insighter, Insighter)
         self._insighters.append(insighter)
+        self._update_pending_insighters()
+
+    def update_contacts(self):
+        """
+        Rebuild the jid aliases of the contacts grouped by name, it has to be called when the contacts of the
+        contact manager change after the creation of the InsighterManager
+        """
+        self._message_jids = dict()
+        self._call_jids = dict()
+        self._jid_aliases = dict()
+        if self._group_by_name:
+            for contact in self.contact_manager:
+                if contact.display_name is not None:
+                    common_contacts = self.contact_manager.get_contacts_by_display_name(contact.display_name)
+                    if common_contacts:
+                        # The same jid is picked in every process, the saved states are keyed by it
+                        self._jid_aliases[contact.jid] = min(common_contact.jid for common_contact in common_contacts)
     
     def update(self, message_or_call):
         if isinstance(message_or_call, Message):
@@ -29,35 +353,135 @@ class InsighterManager:
             return self._update_by_call(message_or_call)
         raise TypeError('expecting Message or Call object')
 
-    def _update_by_message(self, message):
-        if message.remote_jid.endswith('@broadcast') or message.remote_jid.endswith('@temp') \
-                or (not self._include_group and Contact.is_group(message.remote_jid)):
+    def update_messages(self, messages, workers=1):
+        """
+        Apply messages in the insighters
+
+        :param workers: Amount of processes computing the insighters of a MessageStore, each one receives the rows of
+            some jids and the results are merged
+        """
+        insighters = list(self._filter_insighters(MessageInsighter))
+        if isinstance(messages, MessageStore):
+            # The insighters with a batch implementation are computed over the columns of the store, only the
+            # others receive Message objects, which are not created for the rows of ignored chats
+            message_store = messages
+            jids, jid_codes = self._get_message_store_jids(message_store)
+            if workers > 1 and len(jids) > 1:
+                insighters = self._update_message_shards(insighters, message_store, jids, jid_codes, workers)
+            else:
+                insighters = [insighter for insighter in insighters
+                              if not insighter.update_batch(message_store, jids, jid_codes)]
+            if not insighters:
+                return
+            messages = (message_store[index] for index in np.flatnonzero(jid_codes >= 0))
+        for message in messages:
+            self._update_by_message(message, insighters)
+
+    def _is_valid_message_jid(self, jid):
+        jid_type = get_jid_type(jid)
+        return not (jid_type == JidType.BROADCAST or jid_type == JidType.TEMP
+                    or (not self._include_group and jid_type == JidType.GROUP))
+
+    def _update_by_message(self, message, insighters=None):
+        jid = self._resolve_message_jid(message.remote_jid)
+        if jid is None:
             return
 
-        for insighter in self._filter_insighters(MessageInsighter):
-            if message.remote_jid != '-1':
-                if self._group_by_name:
-                    contact = self.contact_manager.get(message.remote_jid)
-                    if contact and contact.display_name is not None:
-                        common_contacts = self.contact_manager.get_contacts_by_display_name(contact.display_name)
-                        message.remote_jid = common_contacts[-1].jid if common_contacts else message.remote_jid
-                insighter.update(message)
+        message.remote_jid = jid
+        for insighter in self._pending_insighters[MessageInsighter] if insighters is None else insighters:
+            insighter.update(message)
 
     def _update_by_call(self, call):
-        if not self._include_group and Contact.is_group(call.remote_jid):
+        jid = self._resolve_call_jid(call.remote_jid)
+        if jid is None:
             return
 
-        for insighter in self._filter_insighters(CallInsighter):
-            if self._group_by_name:
-                contact = self.contact_manager.get(call.remote_jid)
-                if call.remote_jid in self.contact_manager: 
-                    if contact and contact.display_name is not None:
-                        common_contacts = self.contact_manager.get_contacts_by_display_name(contact.display_name)
-                        call.remote_jid = common_contacts[-1].jid if common_contacts else call.remote_jid
+        call.remote_jid = jid
+        for insighter in self._pending_insighters[CallInsighter]:
             insighter.update(call)
 
+    def _update_message_shards(self, insighters, message_store, jids, jid_codes, workers):
+        """
+        Update the insighters with a batch implementation in a process pool, splitting the rows by jid.
+        Return the insighters that could not be updated this way.
+        """
+        # Spread the jids in shards of about the same amount of rows, starting by the jids with more rows
+        shards = min(workers, len(jids))
+        rows_by_jid = np.bincount(jid_codes[jid_codes >= 0], minlength=len(jids))
+        shard_rows = np.zeros(shards, dtype=np.int64)
+        jid_shards = np.empty(len(jids), dtype=np.int32)
+        for code in np.argsort(-rows_by_jid, kind='stable').tolist():
+            shard = int(np.argmin(shard_rows))
+            jid_shards[code] = shard
+            shard_rows[shard] += rows_by_jid[code]
+        row_shards = np.where(jid_codes >= 0, jid_shards[np.maximum(jid_codes, 0)], -1)
+        shard_jids = [[jid for code, jid in enumerate(jids) if jid_shards[code] == shard] for shard in range(shards)]
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=shards, initializer=_set_worker_message_shards,
+                                                    initargs=(message_store, jids, jid_codes, row_shards)) as executor:
+            results = list(executor.map(_update_message_shard, [insighters] * shards, range(shards)))
+
+        pending_insighters = []
+        for index, insighter in enumerate(insighters):
+            if not results[0][1][index]:
+                pending_insighters.append(insighter)
+                continue
+            insighter.merge([(shard_insighters[index], shard_jids[shard])
+                             for shard, (shard_insighters, _) in enumerate(results)])
+        return pending_insighters
+
+    def _get_message_store_jids(self, message_store):
+        """
+        Jids the rows of a MessageStore are accounted to and the code of each row in them, -1 for the ignored rows
+        """
+        jids = []
+        codes = dict()
+        translation = np.full(len(message_store.jids), -1, dtype=np.int32)
+        for code, jid in enumerate(message_store.jids):
+            jid = self._resolve_message_jid(jid)
+            if jid is not None:
+                if jid not in codes:
+                    codes[jid] = len(jids)
+                    jids.append(jid)
+                translation[code] = codes[jid]
+        return jids, translation[message_store.jid_codes]
+
+    def _resolve_message_jid(self, jid):
+        try:
+            return self._message_jids[jid]
+        except KeyError:
+            self._message_jids[jid] = self._get_message_jid(jid)
+            return self._message_jids[jid]
+
+    def _resolve_call_jid(self, jid):
+        try:
+            return self._call_jids[jid]
+        except KeyError:
+            self._call_jids[jid] = self._get_call_jid(jid)
+            return self._call_jids[jid]
+
+    def _get_message_jid(self, jid):
+        if not self._is_valid_message_jid(jid) or jid == '-1':
+            return None
+        return self._get_group_by_name_jid(jid)
+
+    def _get_call_jid(self, jid):
+        if not self._include_group and get_jid_type(jid) == JidType.GROUP:
+            return None
+        return self._get_group_by_name_jid(jid)
+
+    def _get_group_by_name_jid(self, jid):
+        return self._jid_aliases.get(jid, jid)
+
     def _filter_insighters(self, class_):
-        return (insighter for insighter in self._insighters if class_ in insighter.__class__.__bases__)
+        return self._pending_insighters.get(class_, [])
+
+    def _update_pending_insighters(self):
+        self._pending_insighters = {
+            class_: [insighter for insighter in self._insighters
+                     if class_ in insighter.__class__.__bases__ and insighter not in self._sql_insighters]
+            for class_ in (MessageInsighter, CallInsighter)
+        }
 
 
 class Insighter:
@@ -68,10 +492,17 @@ class Insighter:
         self.title = title
         self.format = format_ or '{value:,}'
         self._rank = {}
+        # Row of the data that added each jid to the rank, kept by the batch updates
+        self._rank_positions = {}
+        # Jid of the greatest value, the first one added to the rank among the ties. It is None when the rank is
+        # empty or the winner has to be searched again.
+        self._winner_jid = None
 
     @property
     def winner(self):
-        return max(self._rank.values(), key=lambda item: item.value) if self._rank else None
+        if self._winner_jid is None and self._rank:
+            self._winner_jid = max(self._rank.values(), key=lambda item: item.value).jid
+        return self._rank[self._winner_jid] if self._rank else None
 
     def update(self, data):
         if self.is_valid_data(data):
@@ -83,18 +514,117 @@ class Insighter:
     def handle_data(self, data):
         raise NotImplementedError
 
+    def update_batch(self, message_store, jids, jid_codes):
+        """
+        Update the insighter with all the rows of a MessageStore at once, through NumPy operations over its columns.
+        Each row is accounted to the jid of its code in jid_codes (the rows with code -1 are ignored).
+        Return False when the insighter can only be updated message by message.
+        """
+        return False
+
+    def merge(self, shards):
+        """
+        Combine the states of copies of the insighter, each one updated in another process with the data of some
+        jids only. The result is the same of updating this insighter with all the data.
+
+        :param shards: Pairs of an insighter copy and the jids it has been updated with, the jids of the pairs are
+            disjoint
+        """
+        rank = dict(self._rank)
+        new_jids = []
+        for other, jids in shards:
+            for jid in jids:
+                if jid not in other._rank:
+                    continue
+                if jid not in rank:
+                    new_jids.append((other._rank_positions.get(jid, float('inf')), jid))
+                item = other._rank[jid]
+                rank[jid] = Insighter.InsighterRankItem(jid, item.value, item.track_object, self.format_value)
+                self._merge_jid(other, jid)
+        # The jids added by the shards follow the order in which they would have been added to the rank
+        self._rank = {jid: item for jid, item in rank.items() if jid in self._rank}
+        for _, jid in sorted(new_jids, key=lambda item: item[0]):
+            self._rank[jid] = rank[jid]
+        self._winner_jid = None
+
+    def _merge_jid(self, other, jid):
+        """
+        Copy the state of a jid kept besides the rank from another insighter
+        """
+        pass
+
+    def get_required_fields(self):
+        """
+        Fields of the data read by is_valid_data and handle_data besides the jid, from_me and date.
+        For messages, the fields are the ones of MSGSTORE_MESSAGES_FIELDS, all of them are read by default.
+        """
+        return set(MSGSTORE_MESSAGES_FIELDS)
+
+    def get_row_condition(self):
+        """
+        SQL condition satisfied by all the rows of msgstore.db accepted by is_valid_data, it can only use the
+        tables of the required fields. Return None when every row is needed.
+        """
+        return None
+
+    def get_sql_plan(self):
+        """
+        SQL query computing the insighter rank in msgstore.db, each row is given to handle_sql_row.
+        Return None when the insighter can only be computed from the messages or calls.
+        """
+        return None
+
+    def handle_sql_row(self, row):
+        jid, value = row
+        self._set_contact_rank_value(jid, value)
+
     def format_value(self, value):
         return self.format.format(value=value)
     
     def clear(self):
-        self._winner = None
+        self._winner_jid = None
     
     def get_rank(self):
         return sorted(self._rank.values(), key=lambda item: item.value, reverse=True)
 
-    def _set_contact_rank_value(self, jid, value, insighter_track_object=None):
+    def top(self, k):
+        """
+        The k first items of get_rank, selected without sorting the whole rank
+        """
+        return heapq.nlargest(k, self._rank.values(), key=lambda item: item.value)
+
+    def _set_contact_rank_value(self, jid, value, insighter_track_object=None, position=None):
+        if jid not in self._rank:
+            if position is not None:
+                self._rank_positions[jid] = position
+            if not self._rank:
+                self._winner_jid = jid
+            elif self._winner_jid is not None and value > self._rank[self._winner_jid].value:
+                self._winner_jid = jid
+        elif self._winner_jid is not None:
+            winner_value = self._rank[self._winner_jid].value
+            if jid == self._winner_jid:
+                if value < winner_value:
+                    self._winner_jid = None
+            elif value > winner_value:
+                self._winner_jid = jid
+            elif value == winner_value:
+                # The winner is the first one added among the ties, which is only known by searching it again
+                self._winner_jid = None
         self._rank[jid] = Insighter.InsighterRankItem(jid, value, insighter_track_object, self.format_value)
 
+    def _add_contact_rank_counts(self, jids, jid_codes, mask):
+        """
+        Add to the rank value of each jid its amount of rows selected by the mask
+        """
+        indexes = np.flatnonzero(mask & (jid_codes >= 0))
+        codes = jid_codes[indexes]
+        counts = np.bincount(codes, minlength=len(jids))
+        for code, index in _get_codes_in_order(codes, indexes):
+            jid = jids[code]
+            current_value = self._rank[jid].value if jid in self._rank else 0
+            self._set_contact_rank_value(jid, current_value + int(counts[code]), position=index)
+
     class InsighterRankItem:
         def __init__(self, jid, value, track_object, format_method=None):
             self.jid = jid
@@ -129,16 +659,57 @@ class LongestAudioInsighter(MessageInsighter):
         super().__init__(title, format_)
     
     def is_valid_data(self, message):
-        return not message.from_me and Message.is_voice_message(message.mime_type) \
+        return not message.from_me and message.media_category == MediaCategory.VOICE \
             and message.media_duration and not message.forwarded \
             and (not self.check_media_name or message.media_name and message.media_name.endswith('.opus'))
 
     def handle_data(self, message):
         jid = message.remote_jid 
-        if jid not in self._rank or message.media_duration > self._rank[jid].value \
-            or (message.media_duration == self._rank[jid].value and message.date < self._rank[jid].track_object.date):
+        if self._is_longest(jid, message.media_duration, message.timestamp):
             self._set_contact_rank_value(jid, message.media_duration, message)
 
+    def update_batch(self, message_store, jids, jid_codes):
+        indexes = np.flatnonzero(_get_voice_message_mask(message_store, self.check_media_name) & (jid_codes >= 0))
+        codes = jid_codes[indexes]
+        durations = message_store.media_durations[indexes].astype(np.int64)
+        # Longest audio of each jid, the earliest one on ties
+        order = np.lexsort((indexes, message_store.timestamps[indexes], -durations, codes))
+        longest_indexes = dict(zip(*_get_first_of_groups(codes[order], indexes[order])))
+        for code, first_index in _get_codes_in_order(codes, indexes):
+            index = longest_indexes[code]
+            jid = jids[code]
+            media_duration = int(message_store.media_durations[index])
+            if self._is_longest(jid, media_duration, int(message_store.timestamps[index])):
+                self._set_contact_rank_value(jid, media_duration, _get_store_message(message_store, jids, jid_codes, index),
+                                             first_index)
+        return True
+
+    def _is_longest(self, jid, media_duration, timestamp):
+        return jid not in self._rank or media_duration > self._rank[jid].value \
+            or (media_duration == self._rank[jid].value and timestamp < self._rank[jid].track_object.timestamp)
+
+    def get_required_fields(self):
+        return {'mime_type', 'media_duration', 'forwarded'} | ({'media_name'} if self.check_media_name else set())
+
+    def get_row_condition(self):
+        return VOICE_MESSAGE_PLAN_CONDITION + (OPUS_MEDIA_NAME_PLAN_CONDITION if self.check_media_name else '')
+
+    def get_sql_plan(self):
+        return 'SELECT jid, media_duration, from_me, key_id, status, text_data, timestamp, mime_type, media_name, ' \
+               'forward_score FROM (SELECT insighter_jid.message_jid AS jid, message_media.media_duration, ' \
+               'message.from_me, message.key_id, message.status, message.text_data, message.timestamp, ' \
+               'message_media.mime_type, message_media.media_name, message_forwarded.forward_score, ' \
+               'ROW_NUMBER() OVER (PARTITION BY insighter_jid.message_jid ORDER BY message_media.media_duration DESC, ' \
+               f'COALESCE(message.timestamp, 0), message._id) AS position, {MESSAGE_PLAN_FIRST_ROW_COLUMNS} ' \
+               f'{MESSAGE_PLAN_SOURCE} WHERE {VOICE_MESSAGE_PLAN_CONDITION}' \
+               f'{OPUS_MEDIA_NAME_PLAN_CONDITION if self.check_media_name else ""}) WHERE position = 1 {PLAN_ORDER}'
+
+    def handle_sql_row(self, row):
+        jid, media_duration, from_me, key_id, status, data, timestamp, mime_type, media_name, forwarded = row
+        message = Message(jid, from_me, key_id, status, data, (timestamp or 0) / 1000, None, bool(forwarded),
+                          mime_type, media_duration, media_name)
+        self._set_contact_rank_value(jid, media_duration, message)
+
     def format_value(self, value):
         return time_delta_to_str(value, ['h', 'm', 's'])
 
@@ -154,7 +725,7 @@ class GreatestAudioAmountInsighter(MessageInsighter):
         super().__init__(title, format_)
 
     def is_valid_data(self, message):
-        return not message.from_me and Message.is_voice_message(message.mime_type) \
+        return not message.from_me and message.media_category == MediaCategory.VOICE \
             and message.media_duration and not message.forwarded \
             and (not self.check_media_name or message.media_name and message.media_name.endswith('.opus'))
 
@@ -162,6 +733,21 @@ class GreatestAudioAmountInsighter(MessageInsighter):
         current_value = self._rank[message.remote_jid].value if message.remote_jid in self._rank else 0
         self._set_contact_rank_value(message.remote_jid, current_value + 1)
 
+    def update_batch(self, message_store, jids, jid_codes):
+        self._add_contact_rank_counts(jids, jid_codes, _get_voice_message_mask(message_store, self.check_media_name))
+        return True
+
+    def get_required_fields(self):
+        return {'mime_type', 'media_duration', 'forwarded'} | ({'media_name'} if self.check_media_name else set())
+
+    def get_row_condition(self):
+        return VOICE_MESSAGE_PLAN_CONDITION + (OPUS_MEDIA_NAME_PLAN_CONDITION if self.check_media_name else '')
+
+    def get_sql_plan(self):
+        return 'SELECT jid, COUNT(*) FROM (SELECT insighter_jid.message_jid AS jid, ' \
+               f'{MESSAGE_PLAN_FIRST_ROW_COLUMNS} {MESSAGE_PLAN_SOURCE} WHERE {VOICE_MESSAGE_PLAN_CONDITION}' \
+               f'{OPUS_MEDIA_NAME_PLAN_CONDITION if self.check_media_name else ""}) GROUP BY jid {PLAN_GROUP_ORDER}'
+
 
 class GreatestPhotoAmountInsighter(MessageInsighter):
     def __init__(self, title=None, format_=None):
@@ -170,27 +756,45 @@ class GreatestPhotoAmountInsighter(MessageInsighter):
         super().__init__(title, format_)
 
     def is_valid_data(self, message):
-        return not message.from_me and Message.is_image(message.mime_type)
+        return not message.from_me and message.media_category == MediaCategory.IMAGE
 
     def handle_data(self, message):
         current_value = self._rank[message.remote_jid].value if message.remote_jid in self._rank else 0
         self._set_contact_rank_value(message.remote_jid, current_value + 1)
 
+    def update_batch(self, message_store, jids, jid_codes):
+        received = (message_store.flags & MessageStore.FROM_ME) == 0
+        self._add_contact_rank_counts(jids, jid_codes, received & (message_store.media_categories == MediaCategory.IMAGE))
+        return True
+
+    def get_required_fields(self):
+        return {'mime_type'}
+
+    def get_row_condition(self):
+        return IMAGE_MESSAGE_PLAN_CONDITION
+
+    def get_sql_plan(self):
+        return 'SELECT jid, COUNT(*) FROM (SELECT insighter_jid.message_jid AS jid, ' \
+               f'{MESSAGE_PLAN_FIRST_ROW_COLUMNS} {MESSAGE_PLAN_SOURCE} WHERE {IMAGE_MESSAGE_PLAN_CONDITION}) ' \
+               f'GROUP BY jid {PLAN_GROUP_ORDER}'
+
 
 class GreatestAmountOfDaysTalkingInsighter(MessageInsighter):
     def __init__(self, title=None, format_=None):
         title = title or 'Greatest amount of days talking'
         format_ = format_ or '{value:,} days'
         self._days_messages = dict()
+        self._days = dict()
+        self._min_timestamp = self._get_min_timestamp() * 1000
         super().__init__(title, format_)
     
     def is_valid_data(self, message):
-        return message.date + timedelta(hours=24) > datetime(year=2000, month=1, day=1)
+        return message.timestamp > self._min_timestamp
 
     def handle_data(self, message):
         if message.remote_jid not in self._days_messages:
             self._days_messages[message.remote_jid] = dict()
-        day = int(datetime.combine(message.date, message.date.min.time()).timestamp())
+        day = self._get_day(message)
         if day not in self._days_messages[message.remote_jid]:
             self._days_messages[message.remote_jid][day] = 0b00
         if self._days_messages[message.remote_jid][day] != 0b11:
@@ -200,6 +804,103 @@ class GreatestAmountOfDaysTalkingInsighter(MessageInsighter):
             if self._days_messages[message.remote_jid][day] == 0b11:
                 self._set_contact_rank_value(message.remote_jid, current_value + 1)
 
+    def update_batch(self, message_store, jids, jid_codes):
+        indexes = np.flatnonzero((message_store.timestamps > self._min_timestamp) & (jid_codes >= 0))
+        if not len(indexes):
+            return True
+        slots, slot_codes = np.unique(message_store.timestamps[indexes] // DAY_SLOT_MILLISECONDS, return_inverse=True)
+        slot_days = np.array([self._get_slot_day(message_store.tz, int(slot)) for slot in slots], dtype=np.int64)
+        days, day_codes = np.unique(slot_days[slot_codes], return_inverse=True)
+        pairs = jid_codes[indexes].astype(np.int64) * len(days) + day_codes.reshape(-1)
+        from_me = (message_store.flags[indexes] & MessageStore.FROM_ME) != 0
+
+        # Position of the first message received and sent of each jid and day, len(indexes) if there is none
+        unique_pairs = np.unique(pairs)
+        first_positions = []
+        for side_mask in (~from_me, from_me):
+            positions = np.full(len(unique_pairs), len(indexes), dtype=np.int64)
+            side_pairs, side_positions = np.unique(pairs[side_mask], return_index=True)
+            positions[np.searchsorted(unique_pairs, side_pairs)] = np.flatnonzero(side_mask)[side_positions]
+            first_positions.append(positions)
+        received_positions, sent_positions = first_positions
+
+        pair_codes = unique_pairs // len(days)
+        pair_days = days[unique_pairs % len(days)]
+        group_codes, group_starts = _get_first_of_groups(pair_codes, np.arange(len(unique_pairs)))
+        group_ends = group_starts[1:] + [len(unique_pairs)]
+        previous_sides = np.zeros(len(unique_pairs), dtype=np.int64)
+        for code, start, end in zip(group_codes, group_starts, group_ends):
+            if jids[code] in self._days_messages:
+                jid_days = self._days_messages[jids[code]]
+                previous_sides[start:end] = [jid_days.get(day, 0b00) for day in pair_days[start:end].tolist()]
+        sides = previous_sides | (sent_positions < len(indexes)) << 1 | (received_positions < len(indexes))
+        for code, start, end in zip(group_codes, group_starts, group_ends):
+            self._days_messages.setdefault(jids[code], dict()).update(zip(pair_days[start:end].tolist(),
+                                                                           sides[start:end].tolist()))
+
+        # A day is accounted when both sides have talked, the jids are ranked in the order of their first day
+        talked = (previous_sides != 0b11) & (sides == 0b11)
+        talk_positions = np.maximum(np.where(previous_sides & 0b10, -1, sent_positions),
+                                    np.where(previous_sides & 0b01, -1, received_positions))[talked]
+        talk_codes = pair_codes[talked]
+        amounts = np.bincount(talk_codes, minlength=len(jids))
+        order = np.lexsort((talk_positions, talk_codes))
+        codes, first_talk_positions = _get_first_of_groups(talk_codes[order], talk_positions[order])
+        for code, talk_position in sorted(zip(codes, first_talk_positions), key=lambda item: item[1]):
+            jid = jids[code]
+            current_value = self._rank[jid].value if jid in self._rank else 0
+            self._set_contact_rank_value(jid, current_value + int(amounts[code]), position=int(indexes[talk_position]))
+        return True
+
+    def _merge_jid(self, other, jid):
+        if jid in other._days_messages:
+            self._days_messages[jid] = other._days_messages[jid]
+
+    def get_required_fields(self):
+        return set()
+
+    def get_row_condition(self):
+        return f'COALESCE(message.timestamp, 0) > {self._get_min_timestamp() * 1000}'
+
+    def get_sql_plan(self):
+        # Days are split by the local time, as done by datetime.combine
+        # Each day is accounted when both sides have sent a message, at the first message of the last side to talk.
+        # The rank is ordered by the first of these messages of each jid.
+        talk_window = 'OVER (PARTITION BY jid ORDER BY timestamp, row_id)'
+        return 'SELECT jid, COUNT(*) FROM (' \
+               f'SELECT jid, FIRST_VALUE(timestamp) {talk_window} AS first_timestamp, ' \
+               f'FIRST_VALUE(row_id) {talk_window} AS first_row_id FROM (' \
+               'SELECT jid, timestamp, row_id, COUNT(*) OVER (PARTITION BY jid, day) AS sides, ' \
+               'ROW_NUMBER() OVER (PARTITION BY jid, day ORDER BY timestamp DESC, row_id DESC) AS talk_position FROM (' \
+               'SELECT insighter_jid.message_jid AS jid, COALESCE(message.timestamp, 0) AS timestamp, ' \
+               "message._id AS row_id, date(COALESCE(message.timestamp, 0) / 1000, 'unixepoch', 'localtime') AS day, " \
+               'ROW_NUMBER() OVER (PARTITION BY insighter_jid.message_jid, ' \
+               "date(COALESCE(message.timestamp, 0) / 1000, 'unixepoch', 'localtime'), message.from_me != 0 " \
+               'ORDER BY COALESCE(message.timestamp, 0), message._id) AS side_position ' \
+               f'{MESSAGE_PLAN_SOURCE} WHERE COALESCE(message.timestamp, 0) > {self._get_min_timestamp() * 1000}) ' \
+               'WHERE side_position = 1) WHERE sides = 2 AND talk_position = 1) ' \
+               f'GROUP BY jid {PLAN_GROUP_ORDER}'
+
+    def _get_day(self, message):
+        # Every UTC offset is a multiple of 15 minutes, so all the messages in a slot share the same local day
+        slot = message.tz, message.timestamp // DAY_SLOT_MILLISECONDS
+        if slot not in self._days:
+            self._days[slot] = self._get_date_day(message.date)
+        return self._days[slot]
+
+    def _get_slot_day(self, tz, slot):
+        if (tz, slot) not in self._days:
+            self._days[tz, slot] = self._get_date_day(datetime.fromtimestamp(slot * DAY_SLOT_MILLISECONDS / 1000, tz=tz))
+        return self._days[tz, slot]
+
+    @staticmethod
+    def _get_date_day(date):
+        return int(datetime.combine(date, date.min.time()).timestamp())
+
+    @staticmethod
+    def _get_min_timestamp():
+        return int((datetime(year=2000, month=1, day=1) - timedelta(hours=24)).timestamp())
+
 
 class LongestConversationInsighter(MessageInsighter):
     # To this insighter to work, the messages has to be ordered (ASC or DESC)
@@ -213,12 +914,13 @@ class LongestConversationInsighter(MessageInsighter):
         super().__init__(title, format_)
 
     def handle_data(self, message):
+        # The conversation time is summed in milliseconds
         if message.remote_jid not in self._rank:
             self._conversation_messages[message.remote_jid] = message, message, 0
         first_message, last_message, current_total = self._conversation_messages[message.remote_jid]
-        message_diff_time = abs((message.date - last_message.date).total_seconds())
+        message_diff_time = abs(message.timestamp - last_message.timestamp)
 
-        if message_diff_time <= LongestConversationInsighter.MAX_DIFF:
+        if message_diff_time <= LongestConversationInsighter.MAX_DIFF * 1000:
             last_message = message
             current_total += message_diff_time
         else:
@@ -228,8 +930,71 @@ class LongestConversationInsighter(MessageInsighter):
         self._conversation_messages[message.remote_jid] = first_message, last_message, current_total
 
         jid = message.remote_jid 
-        if message.remote_jid not in self._rank or current_total > self._rank[jid].value:
-            self._set_contact_rank_value(message.remote_jid, current_total, first_message)
+        if message.remote_jid not in self._rank or current_total / 1000 > self._rank[jid].value:
+            self._set_contact_rank_value(message.remote_jid, current_total / 1000, first_message)
+
+    def update_batch(self, message_store, jids, jid_codes):
+        valid_indexes = np.flatnonzero(jid_codes >= 0)
+        if not len(valid_indexes):
+            return True
+        # Messages of each jid next to each other, in their order
+        order = np.argsort(jid_codes[valid_indexes], kind='stable')
+        indexes = valid_indexes[order]
+        codes = jid_codes[indexes]
+        timestamps = message_store.timestamps[indexes].astype(np.int64)
+        diffs = np.abs(np.diff(timestamps, prepend=timestamps[:1]))
+
+        # The first message of a jid continues its conversation of the previous updates, if there is one
+        jid_starts = np.r_[True, codes[1:] != codes[:-1]]
+        previous_totals = np.zeros(len(indexes), dtype=np.int64)
+        has_previous = np.zeros(len(indexes), dtype=bool)
+        for position in np.flatnonzero(jid_starts):
+            jid = jids[codes[position]]
+            if jid in self._rank:
+                _, last_message, previous_totals[position] = self._conversation_messages[jid]
+                diffs[position] = abs(int(timestamps[position]) - last_message.timestamp)
+                has_previous[position] = True
+            else:
+                diffs[position] = 0
+
+        # Total of the conversation at each message: the sum of the differences since the start of the conversation
+        breaks = diffs > LongestConversationInsighter.MAX_DIFF * 1000
+        continued = has_previous & ~breaks
+        segment_starts = jid_starts | breaks
+        increments = np.where(segment_starts & ~continued, 0, diffs)
+        cumulative = np.cumsum(increments)
+        segment_positions = np.flatnonzero(segment_starts)
+        segment_codes = np.cumsum(segment_starts) - 1
+        segment_bases = np.where(continued, previous_totals, 0)[segment_positions] \
+            - (cumulative[segment_positions] - increments[segment_positions])
+        totals = cumulative + segment_bases[segment_codes]
+
+        def get_first_message(position):
+            segment_position = segment_positions[segment_codes[position]]
+            if continued[segment_position]:
+                return self._conversation_messages[jids[codes[segment_position]]][0]
+            return _get_store_message(message_store, jids, jid_codes, indexes[segment_position])
+
+        positions = np.arange(len(indexes))
+        longest_positions = dict(zip(*_get_first_of_groups(codes, positions[np.lexsort((positions, -totals, codes))])))
+        last_positions = dict(zip(*_get_first_of_groups(codes[::-1], positions[::-1])))
+        for code, first_index in _get_codes_in_order(jid_codes[valid_indexes], valid_indexes):
+            jid = jids[code]
+            longest_position = longest_positions[code]
+            longest_total = int(totals[longest_position])
+            if jid not in self._rank or longest_total / 1000 > self._rank[jid].value:
+                self._set_contact_rank_value(jid, longest_total / 1000, get_first_message(longest_position), first_index)
+            last_position = last_positions[code]
+            self._conversation_messages[jid] = get_first_message(last_position), \
+                _get_store_message(message_store, jids, jid_codes, indexes[last_position]), int(totals[last_position])
+        return True
+
+    def _merge_jid(self, other, jid):
+        if jid in other._conversation_messages:
+            self._conversation_messages[jid] = other._conversation_messages[jid]
+
+    def get_required_fields(self):
+        return set()
 
     def format_value(self, value):
         return time_delta_to_str(value, ['h', 'm', 's'])
@@ -246,6 +1011,17 @@ class GreatestMessagesAmountInsighter(MessageInsighter):
         current_value = self._rank[message.remote_jid].value if message.remote_jid in self._rank else 0
         self._set_contact_rank_value(message.remote_jid, current_value + 1)
 
+    def update_batch(self, message_store, jids, jid_codes):
+        self._add_contact_rank_counts(jids, jid_codes, np.ones(len(message_store), dtype=bool))
+        return True
+
+    def get_required_fields(self):
+        return set()
+
+    def get_sql_plan(self):
+        return 'SELECT jid, COUNT(*) FROM (SELECT insighter_jid.message_jid AS jid, ' \
+               f'{MESSAGE_PLAN_FIRST_ROW_COLUMNS} {MESSAGE_PLAN_SOURCE}) GROUP BY jid {PLAN_GROUP_ORDER}'
+
 
 class GreatestMyStatusAnsweredInsighter(MessageInsighter):
     def __init__(self, title=None, format_=None):
@@ -257,10 +1033,21 @@ class GreatestMyStatusAnsweredInsighter(MessageInsighter):
     def is_valid_data(self, message):
         return not message.from_me and message.quote_message and message.quote_message.from_me and message.quote_message.remote_jid == 'status@broadcast'
 
+    def get_required_fields(self):
+        return {'quote_message'}
+
+    def get_row_condition(self):
+        return STATUS_ANSWER_CONDITION
+
     def handle_data(self, message):
         current_value = self._rank[message.remote_jid].value if message.remote_jid in self._rank else 0
         self._set_contact_rank_value(message.remote_jid, current_value + 1)
 
+    def update_batch(self, message_store, jids, jid_codes):
+        received = (message_store.flags & MessageStore.FROM_ME) == 0
+        self._add_contact_rank_counts(jids, jid_codes, received & message_store.quote_mask('status@broadcast', True))
+        return True
+
 
 class LongestCallInsighter(CallInsighter):
     def __init__(self, title=None, format_=None):
@@ -270,9 +1057,21 @@ class LongestCallInsighter(CallInsighter):
     def handle_data(self, call):
         jid = call.remote_jid 
         if jid not in self._rank or call.duration > self._rank[jid].value \
-            or (call.duration == self._rank[jid].value and call.date < self._rank[jid].track_object.date):
+            or (call.duration == self._rank[jid].value and call.timestamp < self._rank[jid].track_object.timestamp):
             self._set_contact_rank_value(jid, call.duration, call)
 
+    def get_sql_plan(self):
+        return 'SELECT jid, from_me, timestamp, video_call, duration, call_result FROM (' \
+               'SELECT insighter_jid.call_jid AS jid, call_log.from_me, call_log.timestamp, call_log.video_call, ' \
+               'call_log.duration, call_log.call_result, ROW_NUMBER() OVER (PARTITION BY insighter_jid.call_jid ' \
+               'ORDER BY call_log.duration DESC, call_log.timestamp, call_log._id) AS position, ' \
+               f'{CALL_PLAN_FIRST_ROW_COLUMNS} {CALL_PLAN_SOURCE}) WHERE position = 1 {PLAN_ORDER}'
+
+    def handle_sql_row(self, row):
+        jid, from_me, timestamp, video_call, duration, call_result = row
+        call = Call(jid, from_me, timestamp / 1000, video_call, duration, call_result)
+        self._set_contact_rank_value(jid, duration, call)
+
     def format_value(self, value):
         return time_delta_to_str(value, ['h', 'm', 's'])
 
@@ -290,6 +1089,10 @@ class GreatestCallAmountInsighter(CallInsighter):
         current_value = self._rank[call.remote_jid].value if call.remote_jid in self._rank else 0
         self._set_contact_rank_value(call.remote_jid, current_value + 1)
 
+    def get_sql_plan(self):
+        return f'SELECT jid, COUNT(*) FROM (SELECT insighter_jid.call_jid AS jid, {CALL_PLAN_FIRST_ROW_COLUMNS} ' \
+               f'{CALL_PLAN_SOURCE} WHERE call_log.duration > 0) GROUP BY jid {PLAN_GROUP_ORDER}'
+
 
 class LongestTimeInCallsInsighter(CallInsighter):
     def __init__(self, title=None, format_=None):
@@ -303,5 +1106,10 @@ class LongestTimeInCallsInsighter(CallInsighter):
         current_value = self._rank[call.remote_jid].value if call.remote_jid in self._rank else 0
         self._set_contact_rank_value(call.remote_jid, current_value + call.duration)
 
+    def get_sql_plan(self):
+        return 'SELECT jid, SUM(duration) FROM (SELECT insighter_jid.call_jid AS jid, call_log.duration, ' \
+               f'{CALL_PLAN_FIRST_ROW_COLUMNS} {CALL_PLAN_SOURCE} WHERE call_log.duration > 0) ' \
+               f'GROUP BY jid {PLAN_GROUP_ORDER}'
+
     def format_value(self, value):
         return time_delta_to_str(value, ['h', 'm', 's'])
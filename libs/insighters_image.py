@@ -283,7 +283,7 @@ def draw_top_insigther_cards(image, insighter, contacts):
     title_height = TOP_INSIGHTER_TITLE_FONT.getsize(title)[1]
     cards_base_y = (TOP_INSIGHTER_BASE_Y + title_height + TOP_INSIGHTER_TITLE_VERTICAL_MARGIN)
 
-    rank = insighter.get_rank()[:3]
+    rank = insighter.top(3)
     for i, rank_item in enumerate(rank):
         display_name, profile_image = contacts[rank_item.jid]
         person_name = display_name.split(' ', 1)[0] if display_name else JID_REGEXP.search(rank_item.jid).group(1)
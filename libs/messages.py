@@ -1,17 +1,67 @@
 import os
 import re
+import sys
+import json
 import uuid
 import typing
-import sqlite3
+import functools
 
-from enum import Enum
+import numpy as np
+
+from enum import Enum, IntEnum
 from datetime import datetime, tzinfo
 
 from .contacts import ContactManager
-from .type import Jid, FilePath, DirPath, MimeType
-from .export_chats import parse_export_chat_file, EXPORT_CHAT_FILE_NAME
+from .database import connect_read_only, fetch_rows, Database, MsgstoreFilter, FETCH_BATCH_SIZE
+from .type import Jid, DirPath, MimeType
+from .export_chats import parse_export_chat_files, ExportChatMessage, EXPORT_CHAT_FILE_NAME
 
 TMessage = typing.TypeVar('TMessage', bound='Message')
+TMessageStore = typing.TypeVar('TMessageStore', bound='MessageStore')
+
+# Fields of the messages that can be left out of the msgstore.db query, the jid, from_me and timestamp are always read
+MSGSTORE_MESSAGES_FIELDS = ('key_id', 'status', 'data', 'mime_type', 'media_name', 'media_duration', 'forwarded',
+                            'quote_message')
+MSGSTORE_MESSAGES_ROW_ID_RANGE_CONDITION = 'WHERE message._id > ? AND message._id <= ? '
+MSGSTORE_MESSAGES_FILTER_COLUMNS = ('message.timestamp', 'jid.raw_string')
+
+
+def get_msgstore_messages_sql(fields: typing.Iterable[str]=None) -> str:
+    """
+    Query of the messages in msgstore.db. The columns of the fields not given are replaced by NULL, keeping
+    the layout of the rows, and the joins needed only by them are skipped.
+
+    :param fields: Fields of MSGSTORE_MESSAGES_FIELDS to read, by default all of them
+    """
+    fields = set(MSGSTORE_MESSAGES_FIELDS if fields is None else fields)
+
+    def column(field: str, name: str) -> str:
+        return name if field in fields else 'NULL'
+
+    columns = [
+        'jid.raw_string', 'message.from_me', column('key_id', 'message.key_id'), column('status', 'message.status'),
+        column('data', 'message.text_data'), 'message.timestamp', column('mime_type', 'message_media.mime_type'),
+        column('media_name', 'message_media.media_name'), column('media_duration', 'message_media.media_duration'),
+        column('forwarded', 'message_forwarded.forward_score'), column('quote_message', 'quoted_jid.raw_string'),
+        column('quote_message', 'message_quoted.from_me'), column('quote_message', 'message_quoted.key_id'), 'NULL',
+        'message_quoted.text_data' if {'quote_message', 'data'} <= fields else 'NULL',
+        column('quote_message', 'message_quoted.timestamp'), 'NULL', 'NULL', 'NULL', 'NULL', 'NULL', 'NULL', 'message._id'
+    ]
+    sql = f'SELECT {", ".join(columns)} ' \
+          'FROM message INNER JOIN chat ON message.chat_row_id = chat._id ' \
+          'INNER JOIN jid ON chat.jid_row_id = jid._id '
+    if fields & {'mime_type', 'media_name', 'media_duration'}:
+        sql += 'LEFT JOIN message_media ON message._id = message_media.message_row_id '
+    if 'forwarded' in fields:
+        sql += 'LEFT JOIN message_forwarded ON message._id = message_forwarded.message_row_id '
+    if 'quote_message' in fields:
+        sql += 'LEFT JOIN message_quoted ON message._id = message_quoted.message_row_id ' \
+               'LEFT JOIN chat AS quoted_chat ON message_quoted.chat_row_id = quoted_chat._id ' \
+               'LEFT JOIN jid AS quoted_jid ON quoted_chat.jid_row_id = quoted_jid._id '
+    return sql
+
+
+MSGSTORE_MESSAGES_SQL = get_msgstore_messages_sql()
 
 
 class Message:
@@ -20,26 +70,41 @@ class Message:
     MIME_TYPE_IMAGE_REGEXP = re.compile(r'image/.*')
     MIME_TYPE_VIDEO_REGEXP = re.compile(r'video/.*')
 
+    __slots__ = ('remote_jid', 'from_me', 'key_id', 'status', 'data', 'timestamp', 'quote_message', 'forwarded',
+                 'mime_type', 'media_category', 'media_duration', 'media_name', 'tz', '_date')
+
     def __init__(self, remote_jid: Jid, from_me: bool, key_id: str, status: int=None,
                  data: str=None, date: typing.Union[float, datetime]=None,
                  quote_message: TMessage=None, forwarded: bool=False,
                  mime_type: MimeType=None, media_duration: int=None,
                  media_name: str=None, tz: tzinfo=None):
-        self.remote_jid: Jid = remote_jid
+        self.remote_jid: Jid = sys.intern(remote_jid) if isinstance(remote_jid, str) else remote_jid
         self.from_me: bool = bool(from_me)
         self.key_id: str = key_id
-        self.status: typing.Union[MessageStatus, int] = None
-        try:
-            self.status: MessageStatus = MessageStatus(status)
-        except ValueError:
-            self.status = status
+        self.status: typing.Union[MessageStatus, int] = MESSAGE_STATUSES.get(status, status)
         self.data: str = data
-        self.date: datetime = datetime.fromtimestamp(date, tz=tz) if not isinstance(date, datetime) else date
         self.quote_message: Message = quote_message
         self.forwarded: bool = forwarded
         self.mime_type: MimeType = mime_type
+        self.media_category: MediaCategory = get_media_category(mime_type)
         self.media_duration: int = media_duration
         self.media_name: str = media_name
+        self.tz: tzinfo = tz
+        if isinstance(date, datetime):
+            self.timestamp: int = round(date.timestamp() * 1000)
+            self._date: datetime = date
+        else:
+            self.timestamp = round(date * 1000)
+            self._date = None
+
+    @property
+    def date(self) -> datetime:
+        """
+        Datetime of the message, created from its epoch timestamp (milliseconds) on the first access
+        """
+        if self._date is None:
+            self._date = datetime.fromtimestamp(self.timestamp / 1000, tz=self.tz)
+        return self._date
 
     def __repr__(self):
         return f'{self.__class__.__name__}{(self.remote_jid, self.from_me, self.status, self.data, self.date, self.mime_type, self.media_duration)}'
@@ -77,89 +142,464 @@ class MessageManager:
         return set(self._contacts)
 
     @staticmethod
-    def from_msgstore_db(db_path: FilePath, tz: tzinfo=None) -> TMessage:
-        sql = 'SELECT jid.raw_string, message.from_me, message.key_id, message.status, message.text_data, ' \
-              'message.timestamp, message_media.mime_type, message_media.media_name, message_media.media_duration, ' \
-              'message_forwarded.forward_score, ' \
-              'NULL, message_quoted.from_me, message_quoted.key_id, NULL, message_quoted.text_data, message_quoted.timestamp, ' \
-              'NULL, NULL, NULL, NULL, NULL, NULL ' \
-              'FROM message INNER JOIN chat ON message.chat_row_id = chat._id ' \
-              'INNER JOIN jid ON chat.jid_row_id = jid._id ' \
-              'LEFT JOIN message_media ON message._id = message_media.message_row_id ' \
-              'LEFT JOIN message_forwarded ON message._id = message_forwarded.message_row_id ' \
-              'LEFT JOIN message_quoted ON message._id = message_quoted.message_row_id '
-        with sqlite3.connect(db_path) as conn:
+    def from_msgstore_db(db_path: Database, tz: tzinfo=None) -> TMessage:
+        with connect_read_only(db_path) as conn:
             message_manager = MessageManager()
-            for row in conn.execute(sql):
-                remote_jid = row[0]
-                from_me = bool(row[1])
-                key_id = row[2]
-                status = row[3]
-                data = row[4]
-                timestamp = row[5] or 0
-                mime_type = row[6]
-                media_name = row[7]
-                media_duration = row[8]
-                forwarded = bool(row[9])
-                message = Message(remote_jid, from_me, key_id, status, data, timestamp / 1000, 
-                                  None, forwarded, mime_type, media_duration, media_name, tz=tz)
-                
+            for row in conn.execute(MSGSTORE_MESSAGES_SQL):
+                message = MessageManager._message_from_msgstore_row(row, tz)
+                remote_jid = message.remote_jid
                 if remote_jid not in message_manager._messages:
                     message_manager._contacts.add(remote_jid)
                     message_manager._messages[remote_jid] = []
                 message_manager._messages[remote_jid].append(message)
-
-                # quoted message
-                quoted_key_id = row[12]
-                if quoted_key_id:
-                    remote_jid = row[10]
-                    from_me = bool(row[11])
-                    key_id = quoted_key_id
-                    status = row[13]
-                    data = row[14]
-                    timestamp = row[15] or 0
-                    mime_type = row[16]
-                    media_name = row[17]
-                    media_duration = row[18]
-                    forwarded = row[19]
-                    message.quote_message = Message(remote_jid, from_me, key_id, status, data, timestamp / 1000, 
-                                                    None, forwarded, mime_type, media_duration, media_name, tz=tz)
-                
+        message_manager._resolve_quote_messages()
         return message_manager
+
+    def _resolve_quote_messages(self):
+        """
+        Replace the quoted messages by the loaded message with the same key (remote_jid, from_me and key_id), so
+        the replies share it
+        """
+        messages_by_key = dict()
+        for message in self:
+            if message.key_id:
+                messages_by_key.setdefault((message.remote_jid, message.from_me, message.key_id), message)
+        for message in self:
+            quote_message = message.quote_message
+            if quote_message:
+                key = quote_message.remote_jid, quote_message.from_me, quote_message.key_id
+                message.quote_message = messages_by_key.get(key, quote_message)
+
+    @staticmethod
+    def iter_messages(db_path: Database, tz: tzinfo=None, batch_size: int=FETCH_BATCH_SIZE,
+                      after_row_id: int=0, last_row_id: int=None, fields: typing.Iterable[str]=None,
+                      condition: str=None, msgstore_filter: MsgstoreFilter=None, offset: int=0) -> typing.Iterator[Message]:
+        """
+        Stream the messages of msgstore.db ordered by date without keeping them in memory
+
+        :param batch_size: Amount of rows fetched from the database at once
+        :param after_row_id: Stream only the messages with row id (message._id) greater than it
+        :param last_row_id: Stream only the messages with row id lower or equal to it, by default the last one
+        :param fields: Fields of MSGSTORE_MESSAGES_FIELDS to read, the others are left as None
+        :param condition: SQL condition the streamed messages must satisfy, using only the tables of the fields read
+        :param msgstore_filter: Date range and chats of the messages to stream
+        :param offset: Amount of messages skipped at the start of the stream
+        """
+        if last_row_id is None:
+            last_row_id = MessageManager.get_last_row_id(db_path)
+        with connect_read_only(db_path) as conn:
+            sql = get_msgstore_messages_sql(fields) + MSGSTORE_MESSAGES_ROW_ID_RANGE_CONDITION
+            parameters = [after_row_id, last_row_id]
+            if condition:
+                sql += f'AND ({condition}) '
+            if msgstore_filter:
+                filter_condition, filter_parameters = msgstore_filter.get_sql_condition(*MSGSTORE_MESSAGES_FILTER_COLUMNS)
+                if filter_condition:
+                    sql += f'AND {filter_condition} '
+                    parameters += filter_parameters
+            sql += 'ORDER BY message.timestamp, message._id LIMIT -1 OFFSET ?'
+            cursor = conn.execute(sql, parameters + [offset])
+            for row in fetch_rows(cursor, batch_size):
+                yield MessageManager._message_from_msgstore_row(row, tz)
+
+    @staticmethod
+    def get_last_row_id(db_path: Database) -> int:
+        with connect_read_only(db_path) as conn:
+            return conn.execute('SELECT MAX(_id) FROM message').fetchone()[0] or 0
+
+    @staticmethod
+    def _message_from_msgstore_row(row: tuple, tz: tzinfo=None) -> Message:
+        remote_jid = row[0]
+        from_me = bool(row[1])
+        key_id = row[2]
+        status = row[3]
+        data = row[4]
+        timestamp = row[5] or 0
+        mime_type = row[6]
+        media_name = row[7]
+        media_duration = row[8]
+        forwarded = bool(row[9])
+        message = Message(remote_jid, from_me, key_id, status, data, timestamp / 1000, 
+                          None, forwarded, mime_type, media_duration, media_name, tz=tz)
+
+        # quoted message, only what message_quoted keeps of it
+        quoted_key_id = row[12]
+        if quoted_key_id:
+            message.quote_message = Message(row[10], row[11], quoted_key_id, None, row[14], (row[15] or 0) / 1000, tz=tz)
+        return message
     
-    def from_export_chats_folder(chats_folder: DirPath, contact_manager: ContactManager=None, tz: tzinfo=None) -> TMessage:
-        message_manager = MessageManager()
-
-        chat_files = [file for file in os.listdir(chats_folder) if EXPORT_CHAT_FILE_NAME.match(file)]
-        for chat_file in chat_files:
-            contact_name = EXPORT_CHAT_FILE_NAME.match(chat_file).group('contact_name')
-            remote_jid = None
-            chat_file = os.path.join(chats_folder, chat_file)
-
-            messages = parse_export_chat_file(chat_file, tz)
-
-            # Find remote_jid
-            for message in messages:
-                if message.contact_name == contact_name:
-                    if contact_manager:
-                        contact = contact_manager.get_contacts_by_display_name(message.contact_name)
-                        remote_jid = contact[0].jid if contact else None
-                    else:
-                        remote_jid = message.dummy_jid 
-                    break
-
-            for message in messages:
-                mime_type = '*/*' if message.media_message else None
-                from_me = message.contact_name != contact_name
-                key_id = str(uuid.uuid4())
-                status = MessageStatus.RECEIVED if from_me else MessageStatus.READ_BY_RECIPIENT
-                message = Message(remote_jid, from_me, key_id, status, message.message, message.date, mime_type=mime_type)
-
-                message_manager._messages.setdefault(remote_jid, [])
-                message_manager._messages[remote_jid].append(message)
+    def from_export_chats_folder(chats_folder: DirPath, contact_manager: ContactManager=None, tz: tzinfo=None,
+                                 workers: int=1) -> TMessage:
+        """
+        Load the messages of the chats exported from WhatsApp
 
+        :param workers: Amount of processes parsing the chat files at the same time
+        """
+        message_manager, _ = load_export_chats_folder(chats_folder, contact_manager, tz, workers)
         return message_manager
 
+    def _add_export_chat_messages(self, contact_name: str, messages: typing.List[ExportChatMessage],
+                                  contact_manager: ContactManager=None):
+        remote_jid = None
+
+        # Find remote_jid
+        for message in messages:
+            if message.contact_name == contact_name:
+                if contact_manager:
+                    contact = contact_manager.get_contacts_by_display_name(message.contact_name)
+                    remote_jid = contact[0].jid if contact else None
+                else:
+                    remote_jid = message.dummy_jid 
+                break
+
+        for message in messages:
+            mime_type = '*/*' if message.media_message else None
+            from_me = message.contact_name != contact_name
+            key_id = str(uuid.uuid4())
+            status = MessageStatus.RECEIVED if from_me else MessageStatus.READ_BY_RECIPIENT
+            message = Message(remote_jid, from_me, key_id, status, message.message, message.date, mime_type=mime_type)
+
+            self._messages.setdefault(remote_jid, [])
+            self._messages[remote_jid].append(message)
+
+
+def load_export_chats_folder(chats_folder: DirPath, contact_manager: ContactManager=None, tz: tzinfo=None,
+                             workers: int=1) -> typing.Tuple[MessageManager, ContactManager]:
+    """
+    Load the messages and the contacts of the chats exported from WhatsApp, parsing each chat file once
+
+    :param contact_manager: Contacts used to find the jid of the chats, by default the jids are made up
+        from the contact names
+    :param workers: Amount of processes parsing the chat files at the same time
+    :return: The messages and the contacts found in the chats
+    """
+    message_manager = MessageManager()
+    chats_contact_manager = ContactManager()
+
+    chat_files = sorted(file for file in os.listdir(chats_folder) if EXPORT_CHAT_FILE_NAME.match(file))
+    chat_files_messages = parse_export_chat_files([os.path.join(chats_folder, file) for file in chat_files],
+                                                  tz, workers)
+    for chat_file, messages in zip(chat_files, chat_files_messages):
+        contact_name = EXPORT_CHAT_FILE_NAME.match(chat_file).group('contact_name')
+        message_manager._add_export_chat_messages(contact_name, messages, contact_manager)
+        chats_contact_manager.add_export_chat_contacts(messages)
+
+    return message_manager, chats_contact_manager
+
+
+class MessageStore:
+    """
+    Columnar storage of messages backed by NumPy arrays. Message objects are only created when a row is accessed.
+    Rows are kept sorted by timestamp.
+    """
+    FROM_ME = 0b01
+    FORWARDED = 0b10
+
+    def __init__(self, tz: tzinfo=None):
+        self.tz: tzinfo = tz
+        self.jids: typing.List[Jid] = []
+        self.mime_types: typing.List[MimeType] = [None]
+        self.timestamps: np.ndarray = np.empty(0, dtype=np.int64)
+        self.jid_codes: np.ndarray = np.empty(0, dtype=np.int32)
+        self.flags: np.ndarray = np.empty(0, dtype=np.uint8)
+        self.mime_codes: np.ndarray = np.empty(0, dtype=np.int16)
+        self.media_categories: np.ndarray = np.empty(0, dtype=np.uint8)
+        self.media_durations: np.ndarray = np.empty(0, dtype=np.int32)
+        self.statuses: np.ndarray = np.empty(0, dtype=np.int16)
+        self.key_ids: np.ndarray = np.empty(0, dtype='S1')
+        self.texts: typing.Optional[typing.List[str]] = None
+        self._media_names: typing.Dict[int, str] = dict()
+        # Quotes of messages found in the store are kept as the row of the quoted message, the others as a
+        # (remote_jid, from_me, key_id, text, timestamp) tuple
+        self._quote_indexes: typing.Dict[int, int] = dict()
+        self._quotes: typing.Dict[int, typing.Tuple[Jid, bool, str, str, int]] = dict()
+        self._quote_messages: typing.Dict[int, Message] = dict()
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __getitem__(self, index: int) -> Message:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('message index out of range')
+        quote_message = None
+        if index in self._quote_indexes:
+            quote_message = self._get_quote_message(self._quote_indexes[index])
+        elif index in self._quotes:
+            quote_remote_jid, quote_from_me, quote_key_id, quote_data, quote_timestamp = self._quotes[index]
+            quote_message = Message(quote_remote_jid, quote_from_me, quote_key_id, None, quote_data,
+                                    quote_timestamp / 1000, tz=self.tz)
+        return self._create_message(index, quote_message)
+
+    def _get_quote_message(self, index: int) -> Message:
+        """
+        Message of a row quoted by other messages, created once and shared by all the replies
+        """
+        if index not in self._quote_messages:
+            self._quote_messages[index] = self._create_message(index)
+        return self._quote_messages[index]
+
+    def _get_quote(self, index: int) -> typing.Tuple[Jid, bool, str, str, int]:
+        flags = int(self.flags[index])
+        return self.jids[self.jid_codes[index]], bool(flags & MessageStore.FROM_ME), self.key_ids[index].decode(), \
+            self.texts[index] if self.texts is not None else None, int(self.timestamps[index])
+
+    def _create_message(self, index: int, quote_message: Message=None) -> Message:
+        flags = int(self.flags[index])
+        status = int(self.statuses[index])
+        return Message(self.jids[self.jid_codes[index]], flags & MessageStore.FROM_ME,
+                       self.key_ids[index].decode(), status if status != -1 else None,
+                       self.texts[index] if self.texts is not None else None,
+                       int(self.timestamps[index]) / 1000, quote_message,
+                       bool(flags & MessageStore.FORWARDED), self.mime_types[self.mime_codes[index]],
+                       int(self.media_durations[index]), self._media_names.get(index), tz=self.tz)
+
+    def __iter__(self) -> typing.Iterator[Message]:
+        return (self[index] for index in range(len(self)))
+
+    @property
+    def contacts(self) -> typing.Set[Jid]:
+        return {self.jids[code] for code in np.unique(self.jid_codes)}
+
+    def jid_mask(self, jids: typing.Iterable[Jid]) -> np.ndarray:
+        """
+        Boolean mask of the rows sent to or received from one of the jids
+        """
+        jids = set(jids)
+        selected_codes = np.array([jid in jids for jid in self.jids], dtype=bool)
+        return selected_codes[self.jid_codes] if self.jids else np.zeros(len(self), dtype=bool)
+
+    def media_name_mask(self, suffix: str, mask: np.ndarray=None) -> np.ndarray:
+        """
+        Boolean mask of the rows whose media name ends with the suffix
+
+        :param mask: If given only the rows selected by it are checked
+        """
+        if mask is None:
+            indexes = [index for index, media_name in self._media_names.items() if media_name.endswith(suffix)]
+        else:
+            indexes = [index for index in np.flatnonzero(mask).tolist()
+                       if self._media_names.get(index, '').endswith(suffix)]
+        media_name_mask = np.zeros(len(self), dtype=bool)
+        media_name_mask[np.array(indexes, dtype=np.int64)] = True
+        return media_name_mask
+
+    def quote_mask(self, remote_jid: Jid, from_me: bool) -> np.ndarray:
+        """
+        Boolean mask of the rows quoting a message of the jid sent (from_me) or received by the user
+        """
+        mask = np.zeros(len(self), dtype=bool)
+        if self._quote_indexes:
+            indexes = np.fromiter(self._quote_indexes.keys(), dtype=np.int64, count=len(self._quote_indexes))
+            quoted_indexes = np.fromiter(self._quote_indexes.values(), dtype=np.int64, count=len(self._quote_indexes))
+            selected_codes = np.array([jid == remote_jid for jid in self.jids], dtype=bool)
+            quoted_from_me = (self.flags[quoted_indexes] & MessageStore.FROM_ME) != 0
+            mask[indexes] = selected_codes[self.jid_codes[quoted_indexes]] & (quoted_from_me == from_me)
+        indexes = [index for index, (jid, quote_from_me, *_) in self._quotes.items()
+                   if jid == remote_jid and bool(quote_from_me) == from_me]
+        mask[np.array(indexes, dtype=np.int64)] = True
+        return mask
+
+    def select(self, mask: np.ndarray) -> TMessageStore:
+        """
+        Create a new MessageStore with the rows selected by a boolean mask
+        """
+        new_indexes = np.cumsum(mask) - 1
+        message_store = MessageStore(self.tz)
+        message_store.jids = list(self.jids)
+        message_store.mime_types = list(self.mime_types)
+        for column in MessageStore._COLUMNS:
+            setattr(message_store, column, getattr(self, column)[mask])
+        if self.texts is not None:
+            message_store.texts = [text for text, selected in zip(self.texts, mask) if selected]
+        message_store._media_names = {int(new_indexes[i]): v for i, v in self._media_names.items() if mask[i]}
+        message_store._quotes = {int(new_indexes[i]): v for i, v in self._quotes.items() if mask[i]}
+        for index, quoted_index in self._quote_indexes.items():
+            if not mask[index]:
+                continue
+            if mask[quoted_index]:
+                message_store._quote_indexes[int(new_indexes[index])] = int(new_indexes[quoted_index])
+            else:
+                message_store._quotes[int(new_indexes[index])] = self._get_quote(quoted_index)
+        return message_store
+
+    def remap_jids(self, mapping: typing.Dict[Jid, Jid]):
+        """
+        Replace the jid of the messages according the mapping, the messages of a jid key will belong to the jid value
+        """
+        jid_codes = {jid: code for code, jid in enumerate(self.jids)}
+        translation = np.arange(len(self.jids), dtype=np.int32)
+        for old_jid, new_jid in mapping.items():
+            if old_jid not in jid_codes or old_jid == new_jid:
+                continue
+            if new_jid not in jid_codes:
+                jid_codes[new_jid] = len(self.jids)
+                self.jids.append(new_jid)
+            translation[jid_codes[old_jid]] = jid_codes[new_jid]
+        self.jid_codes = translation[self.jid_codes]
+        self._quote_messages = dict()
+
+    @staticmethod
+    def from_msgstore_db(db_path: Database, tz: tzinfo=None, load_text: bool=False,
+                         fields: typing.Iterable[str]=None, msgstore_filter: MsgstoreFilter=None) -> TMessageStore:
+        """
+        Load the messages of msgstore.db into a MessageStore
+
+        :param load_text: If true the text of the messages will be loaded too
+        :param fields: Fields of MSGSTORE_MESSAGES_FIELDS to read, by default all of them but the text
+        :param msgstore_filter: Date range and chats of the messages to load
+        """
+        if fields is None:
+            fields = [field for field in MSGSTORE_MESSAGES_FIELDS if field != 'data']
+        fields = set(fields) | ({'data'} if load_text else set())
+        builder = _MessageStoreBuilder(tz, load_text)
+        with connect_read_only(db_path) as conn:
+            sql = get_msgstore_messages_sql(fields)
+            parameters = []
+            if msgstore_filter:
+                filter_condition, parameters = msgstore_filter.get_sql_condition(*MSGSTORE_MESSAGES_FILTER_COLUMNS)
+                if filter_condition:
+                    sql += f'WHERE {filter_condition} '
+            cursor = conn.execute(sql + 'ORDER BY message.timestamp, message._id', parameters)
+            for row in fetch_rows(cursor):
+                quote = None
+                if row[12]:
+                    quote = row[10], bool(row[11]), row[12], row[14] if load_text else None, row[15] or 0
+                builder.append(row[0], row[1], row[2], row[3], row[4], row[5] or 0, row[6], row[7], row[8],
+                               row[9], quote)
+        return builder.build()
+
+    @staticmethod
+    def from_messages(messages: typing.Iterable[Message], tz: tzinfo=None, load_text: bool=False) -> TMessageStore:
+        builder = _MessageStoreBuilder(tz, load_text)
+        for message in sorted(messages, key=lambda message: message.timestamp):
+            quote = None
+            if message.quote_message:
+                quote_message = message.quote_message
+                quote = quote_message.remote_jid, quote_message.from_me, quote_message.key_id, \
+                    quote_message.data if load_text else None, quote_message.timestamp
+            status = message.status.value if isinstance(message.status, MessageStatus) else message.status
+            builder.append(message.remote_jid, message.from_me, message.key_id, status, message.data,
+                           message.timestamp, message.mime_type, message.media_name,
+                           message.media_duration, message.forwarded, quote)
+        return builder.build()
+
+    def save(self, directory: DirPath):
+        """
+        Save the store in a directory, one .npy file per column
+        """
+        os.makedirs(directory, exist_ok=True)
+        for column in MessageStore._COLUMNS:
+            np.save(os.path.join(directory, f'{column}.npy'), getattr(self, column))
+        metadata = {
+            'jids': self.jids,
+            'mime_types': self.mime_types,
+            'texts': self.texts,
+            'media_names': list(self._media_names.items()),
+            'quote_indexes': list(self._quote_indexes.items()),
+            'quotes': [(index, *quote) for index, quote in self._quotes.items()]
+        }
+        with open(os.path.join(directory, MessageStore._METADATA_FILE), 'w', encoding='utf-8') as file:
+            json.dump(metadata, file)
+
+    @staticmethod
+    def load(directory: DirPath, tz: tzinfo=None, mmap: bool=True) -> TMessageStore:
+        """
+        Load a store saved by MessageStore.save
+
+        :param mmap: If true the columns will be memory-mapped instead of read
+        """
+        message_store = MessageStore(tz)
+        for column in MessageStore._COLUMNS:
+            setattr(message_store, column, np.load(os.path.join(directory, f'{column}.npy'),
+                                                   mmap_mode='r' if mmap else None))
+        with open(os.path.join(directory, MessageStore._METADATA_FILE), encoding='utf-8') as file:
+            metadata = json.load(file)
+        message_store.jids = metadata['jids']
+        message_store.mime_types = metadata['mime_types']
+        message_store.texts = metadata['texts']
+        message_store._media_names = {index: media_name for index, media_name in metadata['media_names']}
+        message_store._quote_indexes = {index: quoted_index for index, quoted_index in metadata['quote_indexes']}
+        message_store._quotes = {index: tuple(quote) for index, *quote in metadata['quotes']}
+        return message_store
+
+    _COLUMNS = ('timestamps', 'jid_codes', 'flags', 'mime_codes', 'media_categories',
+                'media_durations', 'statuses', 'key_ids')
+    _METADATA_FILE = 'metadata.json'
+
+
+class _MessageStoreBuilder:
+    def __init__(self, tz: tzinfo=None, load_text: bool=False):
+        self._message_store = MessageStore(tz)
+        self._load_text = load_text
+        self._jid_codes: typing.Dict[Jid, int] = dict()
+        self._mime_codes: typing.Dict[MimeType, int] = {None: 0}
+        self._columns: typing.Dict[str, typing.List] = {column: [] for column in MessageStore._COLUMNS}
+        self._texts: typing.List[str] = []
+
+    def append(self, remote_jid: Jid, from_me: bool, key_id: str, status: int, data: str, timestamp: int,
+               mime_type: MimeType, media_name: str, media_duration: int, forwarded: bool,
+               quote: typing.Tuple[Jid, bool, str, str, int]=None):
+        message_store = self._message_store
+        index = len(self._columns['timestamps'])
+        if remote_jid not in self._jid_codes:
+            self._jid_codes[remote_jid] = len(message_store.jids)
+            message_store.jids.append(remote_jid)
+        if mime_type not in self._mime_codes:
+            self._mime_codes[mime_type] = len(message_store.mime_types)
+            message_store.mime_types.append(mime_type)
+        flags = (MessageStore.FROM_ME if from_me else 0) | (MessageStore.FORWARDED if forwarded else 0)
+        self._columns['timestamps'].append(timestamp)
+        self._columns['jid_codes'].append(self._jid_codes[remote_jid])
+        self._columns['flags'].append(flags)
+        self._columns['mime_codes'].append(self._mime_codes[mime_type])
+        self._columns['media_durations'].append(media_duration or 0)
+        self._columns['statuses'].append(status if status is not None else -1)
+        self._columns['key_ids'].append((key_id or '').encode())
+        if self._load_text:
+            self._texts.append(data)
+        if media_name is not None:
+            message_store._media_names[index] = media_name
+        if quote:
+            message_store._quotes[index] = quote
+
+    def build(self) -> MessageStore:
+        message_store = self._message_store
+        columns = self._columns
+        message_store.timestamps = np.array(columns['timestamps'], dtype=np.int64)
+        message_store.jid_codes = np.array(columns['jid_codes'], dtype=np.int32)
+        message_store.flags = np.array(columns['flags'], dtype=np.uint8)
+        message_store.mime_codes = np.array(columns['mime_codes'], dtype=np.int16)
+        message_store.media_durations = np.array(columns['media_durations'], dtype=np.int32)
+        message_store.statuses = np.array(columns['statuses'], dtype=np.int16)
+        message_store.key_ids = np.array(columns['key_ids'], dtype='S') if columns['key_ids'] else np.empty(0, dtype='S1')
+        categories = np.array([get_media_category(mime_type) for mime_type in message_store.mime_types], dtype=np.uint8)
+        message_store.media_categories = categories[message_store.mime_codes]
+        if self._load_text:
+            message_store.texts = self._texts
+        self._resolve_quotes()
+        return message_store
+
+    def _resolve_quotes(self):
+        """
+        Point the quotes to the row of the quoted message, with the same jid, from_me and key_id, when it is in
+        the store
+        """
+        message_store = self._message_store
+        if not message_store._quotes:
+            return
+        rows_by_key: typing.Dict[typing.Tuple[int, bool, bytes], int] = dict()
+        for index, (jid_code, flags, key_id) in enumerate(zip(self._columns['jid_codes'], self._columns['flags'],
+                                                              self._columns['key_ids'])):
+            if key_id:
+                rows_by_key.setdefault((jid_code, bool(flags & MessageStore.FROM_ME), key_id), index)
+        for index, (jid, from_me, key_id, _, _) in list(message_store._quotes.items()):
+            quoted_index = rows_by_key.get((self._jid_codes.get(jid), from_me, (key_id or '').encode()))
+            if quoted_index is not None:
+                message_store._quote_indexes[index] = quoted_index
+                del message_store._quotes[index]
+
 
 class MessageStatus(Enum):
     RECEIVED = 0
@@ -169,5 +609,32 @@ class MessageStatus(Enum):
     READ_BY_RECIPIENT = 13
 
 
+MESSAGE_STATUSES = {status.value: status for status in MessageStatus}
+
+
+class MediaCategory(IntEnum):
+    NONE = 0
+    OTHER = 1
+    IMAGE = 2
+    VIDEO = 3
+    AUDIO = 4
+    VOICE = 5
+
+
+@functools.lru_cache(maxsize=None)
+def get_media_category(mime_type: MimeType) -> MediaCategory:
+    if not mime_type:
+        return MediaCategory.NONE
+    elif Message.is_voice_message(mime_type):
+        return MediaCategory.VOICE
+    elif Message.is_audio(mime_type):
+        return MediaCategory.AUDIO
+    elif Message.is_image(mime_type):
+        return MediaCategory.IMAGE
+    elif Message.is_video(mime_type):
+        return MediaCategory.VIDEO
+    return MediaCategory.OTHER
+
+
 if __name__ == '__main__':
     message_manager = MessageManager.from_msgstore_db('msgstore.db')
\ No newline at end of file
@@ -1,21 +1,33 @@
 import io
 import os
 import re
+import math
 import zlib
 import locale
 import base64
 import typing
+import sqlite3
 import subprocess
 import contextlib
 
+import tqdm
+import numpy as np
+
 from PIL import Image
 from Crypto.Cipher import AES
 from difflib import SequenceMatcher
 
-from .messages import Message
+from .messages import Message, MessageStore
 from .type import FilePath, Jid
 from .contacts import ContactManager
 
+DECRYPT_CHUNK_SIZE = 1024 * 1024
+
+SIMILARITY_THRESHOLD = 0.95
+SIMILARITY_NGRAM_SIZE = 3
+# N-grams present in more strings than this are only counted when needed to tell the candidates apart
+SIMILARITY_FREQUENT_NGRAM = 64
+
 
 def get_adb_serials(include_emulators: bool=True) -> typing.List[str]:
     out = subprocess.check_output(['adb', 'devices'], shell=True, text=True).strip('\r\n').strip('\n')
@@ -47,7 +59,12 @@ def pillow_image_to_base64(image: Image, format_: str):
     return base64.b64encode(buffer.getvalue()).decode('ascii')
 
 
-def decrypt_whatsapp_database(db_file: FilePath, key_file: FilePath, output: FilePath):
+def iter_decrypted_whatsapp_database(db_file: FilePath, key_file: FilePath, chunk_size: int=DECRYPT_CHUNK_SIZE,
+                                     show_progress: bool=True) -> typing.Iterator[bytes]:
+    """
+    Decrypt and decompress a crypt12/crypt14 backup chunk by chunk, the memory used does not depend on its size.
+    The GCM authentication tag is verified after the last chunk, a RuntimeError is raised if it does not match.
+    """
     # Credits to https://github.com/B16f00t/whapa/blob/master/libs/whacipher.py
 
     if os.path.getsize(key_file) != 158:
@@ -57,29 +74,141 @@ def decrypt_whatsapp_database(db_file: FilePath, key_file: FilePath, output: Fil
         key_data = file.read()
 
     key = key_data[126:]
-    with open(db_file, 'rb') as file:
-        db_data = file.read()
-    
+
     _, db_extension = os.path.splitext(db_file)
 
     if db_extension == '.crypt14':
-        data = db_data[191:]
-        iv = db_data[67:83]
+        header_size, iv_start, iv_end, footer_size = 191, 67, 83, 32
     elif db_extension == '.crypt12':
-        data = db_data[67:-20]
-        iv = db_data[51:67]
+        header_size, iv_start, iv_end, footer_size = 67, 51, 67, 20
     else:
         raise OSError('DB encrypt not supported')
-    
-    aes = AES.new(key, mode=AES.MODE_GCM, nonce=iv)
-    with open(output, 'wb') as file:
-        file.write(zlib.decompress(aes.decrypt(data)))
+
+    data_size = os.path.getsize(db_file) - header_size - footer_size
+    if data_size <= 0:
+        raise RuntimeError('Invalid database file')
+
+    try:
+        with open(db_file, 'rb') as db:
+            iv = db.read(header_size)[iv_start:iv_end]
+            aes = AES.new(key, mode=AES.MODE_GCM, nonce=iv)
+            decompressor = zlib.decompressobj()
+            with tqdm.tqdm(total=data_size, unit='B', unit_scale=True, disable=not show_progress) as progress:
+                remaining = data_size
+                while remaining:
+                    chunk = db.read(min(chunk_size, remaining))
+                    remaining -= len(chunk)
+                    yield decompressor.decompress(aes.decrypt(chunk))
+                    progress.update(len(chunk))
+            yield decompressor.flush()
+            aes.verify(db.read(16))
+            if not decompressor.eof:
+                raise ValueError('incomplete compressed data')
+    except (ValueError, zlib.error) as error:
+        raise RuntimeError('The database could not be decrypted, check the key and the database file') from error
+
+
+def decrypt_whatsapp_database(db_file: FilePath, key_file: FilePath, output: FilePath,
+                              chunk_size: int=DECRYPT_CHUNK_SIZE, show_progress: bool=True):
+    """
+    Decrypt a crypt12/crypt14 backup into a file, the output is removed if the backup can not be decrypted
+    """
+    try:
+        with open(output, 'wb') as file:
+            for data in iter_decrypted_whatsapp_database(db_file, key_file, chunk_size, show_progress):
+                file.write(data)
+    except (RuntimeError, OSError):
+        if os.path.exists(output):
+            os.remove(output)
+        raise
+
+
+def decrypt_whatsapp_database_to_memory(db_file: FilePath, key_file: FilePath, chunk_size: int=DECRYPT_CHUNK_SIZE,
+                                        show_progress: bool=True) -> sqlite3.Connection:
+    """
+    Decrypt a crypt12/crypt14 backup into an in-memory SQLite database, nothing is written to the disk
+    """
+    if not hasattr(sqlite3.Connection, 'deserialize'):
+        raise RuntimeError('Decrypting into memory requires Python 3.11 or newer')
+    data = bytearray()
+    for chunk in iter_decrypted_whatsapp_database(db_file, key_file, chunk_size, show_progress):
+        data += chunk
+    conn = sqlite3.connect(':memory:')
+    conn.deserialize(data)
+    return conn
 
 
 def string_similarity(string: str, string2: str) -> float:
     return SequenceMatcher(None, string, string2).ratio()
 
 
+def _count_ngrams(string: str, size: int=SIMILARITY_NGRAM_SIZE) -> typing.Dict[str, int]:
+    ngrams = dict()
+    for i in range(len(string) - size + 1):
+        ngram = string[i:i + size]
+        ngrams[ngram] = ngrams.get(ngram, 0) + 1
+    return ngrams
+
+
+class SimilarityIndex:
+    """
+    Trigram index of strings to find the ones that can reach a similarity threshold with another string.
+    The candidates are a superset of the strings whose string_similarity is at least the threshold, so only they
+    need to be compared.
+    """
+    def __init__(self, strings: typing.Iterable[str], threshold: float=SIMILARITY_THRESHOLD):
+        self.threshold: float = threshold
+        self._lengths: typing.List[int] = []
+        self._positions_by_length: typing.Dict[int, typing.List[int]] = dict()
+        self._ngrams: typing.Dict[str, typing.List[typing.Tuple[int, int]]] = dict()
+        for position, string in enumerate(strings):
+            length = len(string) if string else 0
+            self._lengths.append(length)
+            if not length:
+                continue
+            self._positions_by_length.setdefault(length, []).append(position)
+            for ngram, count in _count_ngrams(string).items():
+                self._ngrams.setdefault(ngram, []).append((position, count))
+
+    def get_candidates(self, string: str) -> typing.List[int]:
+        """
+        Positions (in the order the strings were indexed) of the strings that may be similar to the string
+        """
+        if not string:
+            return []
+
+        # The ratio is 2 * M / T, with M the matched characters and T the sum of both lengths, so the lengths can
+        # not be too far apart and at most D = T - 2 * M characters are left out of the matching blocks
+        length = len(string)
+        threshold = self.threshold
+        min_length = math.ceil(length * threshold / (2 - threshold) - 1e-6)
+        max_length = math.floor(length * (2 - threshold) / threshold + 1e-6)
+        max_differences = math.floor((length + max_length) * (1 - threshold) + 1e-6)
+
+        # Each left out character or boundary between matching blocks breaks at most SIMILARITY_NGRAM_SIZE n-grams of
+        # the string, the remaining ones are also found in the similar string
+        ngrams = _count_ngrams(string)
+        min_shared = (length - SIMILARITY_NGRAM_SIZE + 1) - SIMILARITY_NGRAM_SIZE * max_differences
+        if min_shared <= 0:
+            return sorted(position for other_length in range(min_length, max_length + 1)
+                          for position in self._positions_by_length.get(other_length, ()))
+
+        # The most frequent n-grams are assumed to be shared with every string, as long as at least one shared
+        # n-gram is still required among the counted ones
+        postings = sorted(((self._ngrams.get(ngram, ()), count) for ngram, count in ngrams.items()),
+                          key=lambda item: len(item[0]))
+        while postings and len(postings[-1][0]) > SIMILARITY_FREQUENT_NGRAM and postings[-1][1] < min_shared:
+            min_shared -= postings.pop()[1]
+
+        shared = dict()
+        for ngram_postings, count in postings:
+            for position, other_count in ngram_postings:
+                shared[position] = shared.get(position, 0) + min(count, other_count)
+
+        return sorted(position for position, shared_count in shared.items()
+                      if shared_count >= min_shared and min_length <= self._lengths[position] <= max_length)
+
+
 @contextlib.contextmanager
 def context_locale(locale_: str):
     default_locale = f'{locale.getdefaultlocale()[0]}.UTF-8'
@@ -92,6 +221,9 @@ def context_locale(locale_: str):
 
 def group_messages_by_contact_name(contact_manager: ContactManager,
                                    sorted_messages: typing.Iterable[Message]) -> typing.List[Message]:
+    if isinstance(sorted_messages, MessageStore):
+        return group_message_store_by_contact_name(contact_manager, sorted_messages)
+
     messages = list(sorted_messages)
     contact_name_most_recent = dict()
     for message in messages:
@@ -107,5 +239,22 @@ def group_messages_by_contact_name(contact_manager: ContactManager,
     return messages
 
 
+def group_message_store_by_contact_name(contact_manager: ContactManager, message_store: MessageStore) -> MessageStore:
+    # Visit the jids in the order of their most recent message, so the last one wins as in the message list version
+    last_indexes = np.full(len(message_store.jids), -1, dtype=np.int64)
+    np.maximum.at(last_indexes, message_store.jid_codes, np.arange(len(message_store), dtype=np.int64))
+    contact_name_most_recent = dict()
+    for code in np.argsort(last_indexes, kind='stable'):
+        if last_indexes[code] < 0:
+            continue
+        contact = contact_manager.get(message_store.jids[code])
+        if contact and contact.display_name:
+            for c in contact_manager.get_contacts_by_display_name(contact.display_name):
+                contact_name_most_recent[c.jid] = contact.jid
+
+    message_store.remap_jids(contact_name_most_recent)
+    return message_store
+
+
 def get_profile_image_filename_by_jid(jid: Jid):
     return f'{jid}.jpg'
@@ -4,21 +4,24 @@ import json
 import base64
 import typing
 import logging
+import sqlite3
 import argparse
 import tempfile
 import requests
 
 from PIL import Image
+from datetime import datetime
 
 from libs import automation, utils
 from libs.android import Android
 from libs.type import Base64Image
-from libs.calls import CallManager
+from libs.cache import MsgstoreCache
+from libs.database import get_indexed_database, MsgstoreFilter
 from libs.sdk_manager import SDKManager
-from libs.messages import MessageManager
+from libs.messages import MessageStore, load_export_chats_folder
 from libs.android_emulator import AndroidEmulator
-from libs.contacts import JID_REGEXP, Contact, ContactManager
-from libs.insighters import InsighterManager, LongestAudioInsighter, \
+from libs.contacts import JID_REGEXP, ContactManager, JidType, get_jid_type, join_contacts
+from libs.insighters import InsighterManager, MessageInsighter, CallInsighter, LongestAudioInsighter, \
     GreatestAudioAmountInsighter, GreatestAmountOfDaysTalkingInsighter, \
     LongestConversationInsighter, GreatestMessagesAmountInsighter, \
     GreatestMyStatusAnsweredInsighter, GreatestPhotoAmountInsighter, \
@@ -48,6 +51,7 @@ DEFAULT_PROFILE_IMAGE = os.path.join(os.path.dirname(__file__), 'images', 'profi
 LOCALE_DIR = os.path.join(os.path.dirname(__file__), 'locale')
 
 RANK_DATE_FORMAT = '%d %b %Y %H:%M:%S'
+ENCRYPTED_DATABASE_EXTENSIONS = ('.crypt12', '.crypt14')
 CHROMEDRIVER_BIN = 'chromedriver.exe' if os.name == 'nt' else 'chromedriver'
 
 # WhatsApp Messenger 2.21.16.20 (x86_64) (Android 4.1+)
@@ -184,7 +188,100 @@ def extract_database(backup, serial, key, output):
         logging.info(f'Database extracted!')
 
 
-def generate_image(msg_store, locale, profile_pictures_dir, contacts, insighters, top_insighter, output):
+def open_msgstore(msg_store, key=None, index_joins=False, cache_dir=None):
+    """
+    Get the messages database to read, an encrypted backup is decrypted into an in-memory database.
+    Return None when it can not be opened.
+    """
+    _, extension = os.path.splitext(msg_store)
+    if extension in ENCRYPTED_DATABASE_EXTENSIONS:
+        if not key or not os.path.isfile(key):
+            logging.error(f'Key file not found in path "{key}"')
+            return None
+        logging.info('Decrypting database backup in memory...')
+        try:
+            msg_store = utils.decrypt_whatsapp_database_to_memory(msg_store, key)
+        except RuntimeError as error:
+            logging.error(str(error))
+            return None
+
+    if index_joins:
+        logging.info('Indexing the joins of the messages database...')
+        msg_store = get_indexed_database(msg_store, cache_dir)
+    return msg_store
+
+
+def create_msgstore_cache(msg_store, cache_dir=None):
+    if not cache_dir:
+        return None
+    if isinstance(msg_store, sqlite3.Connection):
+        logging.warning('The database cache is not used when the backup is decrypted in memory')
+        return None
+    return MsgstoreCache(cache_dir)
+
+
+def create_msgstore_filter(since=None, until=None, jids=None, exclude_groups=False):
+    if since or until or jids or exclude_groups:
+        return MsgstoreFilter(since, until, jids, exclude_groups)
+    return None
+
+
+def apply_msgstore_in_insighters(insighter_manager, msg_store, sql_pushdown=False, msgstore_cache=None,
+                                 state_file=None, msgstore_filter=None, workers=1):
+    if state_file and msgstore_filter:
+        logging.warning('The insighters state is not kept when the messages and calls are filtered')
+        state_file = None
+
+    if state_file and os.path.exists(state_file):
+        logging.info('Loading insighters state...')
+        try:
+            if not insighter_manager.load_state(state_file):
+                logging.warning('The insighters state was saved by another version or with other insighters, it will be ignored')
+        except ValueError as error:
+            logging.error(f'{error}, remove the file "{state_file}" to compute the insighters again')
+            return False
+
+    if state_file and (sql_pushdown or msgstore_cache):
+        logging.warning('The SQL pushdown and the database cache are not used when the insighters state is kept')
+        sql_pushdown = False
+        msgstore_cache = None
+
+    if sql_pushdown:
+        logging.info('Computing insighters in the database...')
+        insighter_manager.apply_sql_plans(msg_store, msgstore_filter)
+
+    if msgstore_cache:
+        if insighter_manager.has_pending_insighters(MessageInsighter):
+            logging.info('Applying messages in the insighters...')
+            message_store = msgstore_cache.get_message_store(msg_store)
+            if msgstore_filter:
+                message_store = message_store.select(msgstore_filter.get_mask(message_store))
+            insighter_manager.update_messages(message_store, workers)
+
+        if insighter_manager.has_pending_insighters(CallInsighter):
+            logging.info('Applying calls in the insighters...')
+            for call in sorted(msgstore_cache.get_call_manager(msg_store), key=lambda call: call.timestamp):
+                if not msgstore_filter or msgstore_filter.is_selected(call.remote_jid, call.timestamp):
+                    insighter_manager.update(call)
+    else:
+        logging.info('Loading and applying messages and calls in the insighters...')
+        insighter_manager.update_from_msgstore_db(msg_store, msgstore_filter=msgstore_filter, checkpoint_file=state_file)
+
+    if state_file:
+        logging.info('Saving insighters state...')
+        insighter_manager.save_state(state_file)
+    return True
+
+
+def load_msgstore_contacts(msg_store, msgstore_cache=None):
+    if msgstore_cache:
+        return msgstore_cache.get_contact_manager(msg_store)
+    return ContactManager.from_msgtore_db(msg_store)
+
+
+def generate_image(msg_store, locale, profile_pictures_dir, contacts, insighters, top_insighter, output,
+                   sql_pushdown=False, cache_dir=None, state_file=None, index_joins=False, since=None, until=None,
+                   jids=None, exclude_groups=False, key=None, jobs=1):
     try:
         insighters_classes = [INSIGHTERS[i] for i in insighters]
     except KeyError as error:
@@ -216,18 +313,24 @@ def generate_image(msg_store, locale, profile_pictures_dir, contacts, insighters
             with open(locale_path, encoding='utf-8') as file:
                 locale_strings = json.load(file)
     
+    msg_store = open_msgstore(msg_store, key, index_joins, cache_dir)
+    if msg_store is None:
+        return
+
+    msgstore_cache = create_msgstore_cache(msg_store, cache_dir)
+
     logging.info('Loading contacts...')
     vcf_contact_manager = ContactManager.from_vcf(contacts)
-    contact_manager = ContactManager.from_msgtore_db(msg_store)
+    contact_manager = load_msgstore_contacts(msg_store, msgstore_cache)
     
     logging.info('Getting contact and profile pictures from vcf...')
+    vcf_contacts = join_contacts(contact_manager.get_users(), vcf_contact_manager.get_users())
     for contact in contact_manager.get_users():
-        for vcf_contact in vcf_contact_manager.get_users():
-            if utils.string_similarity(vcf_contact.jid, contact.jid) >= 0.95:
-                if not contact.display_name:
-                    contact_manager.update_contact_diplay_name(contact.jid, vcf_contact.display_name)
-                contact.profile_image = vcf_contact.profile_image
-                break
+        vcf_contact = vcf_contacts.get(contact.jid)
+        if vcf_contact:
+            if not contact.display_name:
+                contact_manager.update_contact_diplay_name(contact.jid, vcf_contact.display_name)
+            contact.profile_image = vcf_contact.profile_image
 
     logging.info('Identifying profile pictures in the directory provided...')
     profile_pictures = dict()
@@ -246,19 +349,10 @@ def generate_image(msg_store, locale, profile_pictures_dir, contacts, insighters
         format_ = insighter_strings.get('format')
         insighter_manager.add_insighter(insighter(title=title, format_=format_))
 
-    logging.info('Loading call logs...')
-    call_manager = CallManager.from_msgstore_db(msg_store)
-    
-    logging.info('Loading messages...')
-    message_manager = MessageManager.from_msgstore_db(msg_store)
-
-    logging.info('Applying messages in the insighters...')
-    for message in message_manager:
-        insighter_manager.update(message)
-
-    logging.info('Applying calls in the insighters...')
-    for call in call_manager:
-        insighter_manager.update(call)
+    msgstore_filter = create_msgstore_filter(since, until, jids, exclude_groups)
+    if not apply_msgstore_in_insighters(insighter_manager, msg_store, sql_pushdown, msgstore_cache, state_file,
+                                        msgstore_filter, jobs):
+        return
 
     logging.info('Result')
     logging.info('')
@@ -291,12 +385,15 @@ def generate_image(msg_store, locale, profile_pictures_dir, contacts, insighters
 
 
 def generate_video(msg_store, locale, profile_pictures_dir, contacts, output, export_chats_folder,
-                   exclude_no_display_name_contacts=False, group_contact_by_name=True):
+                   exclude_no_display_name_contacts=False, group_contact_by_name=True, cache_dir=None, jobs=1,
+                   index_joins=False, since=None, until=None, jids=None, exclude_groups=False, key=None):
     if not output:
         logging.error('No output file provided')
         return
 
-    message_manager = None
+    msgstore_filter = create_msgstore_filter(since, until, jids, exclude_groups)
+
+    message_store = None
     vcf_contact_manager = None
     if not contacts or not os.path.isfile(contacts):
         logging.warning(f'The contacts file was not found: "{contacts}". The contacts name may not be shown.')
@@ -308,16 +405,27 @@ def generate_video(msg_store, locale, profile_pictures_dir, contacts, output, ex
         return
     elif export_chats_folder:
         logging.info('Loading messages...')
-        message_manager = MessageManager.from_export_chats_folder(export_chats_folder,
-                                                                  vcf_contact_manager)
-        contact_manager = ContactManager.from_export_chats_folder(export_chats_folder)
+        message_manager, contact_manager = load_export_chats_folder(export_chats_folder, vcf_contact_manager,
+                                                                    workers=jobs)
+        message_store = MessageStore.from_messages(message_manager)
+        if msgstore_filter:
+            message_store = message_store.select(msgstore_filter.get_mask(message_store))
     elif not msg_store or not os.path.isfile(msg_store):
         logging.error(f'Messages database not found in path "{msg_store}"')
         return
     elif msg_store:
+        msg_store = open_msgstore(msg_store, key, index_joins, cache_dir)
+        if msg_store is None:
+            return
         logging.info('Loading messages...')
-        message_manager = MessageManager.from_msgstore_db(msg_store)
-        contact_manager = ContactManager.from_msgtore_db(msg_store)
+        msgstore_cache = create_msgstore_cache(msg_store, cache_dir)
+        if msgstore_cache:
+            message_store = msgstore_cache.get_message_store(msg_store)
+            if msgstore_filter:
+                message_store = message_store.select(msgstore_filter.get_mask(message_store))
+        else:
+            message_store = MessageStore.from_msgstore_db(msg_store, fields=(), msgstore_filter=msgstore_filter)
+        contact_manager = load_msgstore_contacts(msg_store, msgstore_cache)
     else:
         logging.error('Set msgstore or export chats folder to get the messages')
         return
@@ -354,12 +462,13 @@ def generate_video(msg_store, locale, profile_pictures_dir, contacts, output, ex
                     other_contact.profile_image = profile_image
 
     logging.info('Excluding groups...')
-    messages = []
-    for message in message_manager:
-        if Contact.is_user(message.remote_jid):
-            contact = contact_manager.get(message.remote_jid)
+    included_jids = set()
+    for jid in message_store.jids:
+        if get_jid_type(jid) == JidType.USER:
+            contact = contact_manager.get(jid)
             if (not exclude_no_display_name_contacts or (contact and contact.display_name)):
-                messages.append(message)
+                included_jids.add(jid)
+    messages = message_store.select(message_store.jid_mask(included_jids))
 
     if group_contact_by_name:
         logging.info('Grouping contacts by name...')
@@ -421,7 +530,9 @@ def extract_profile_images(msg_store, output, chromedriver, update_existent_imag
                 logging.info(f'"{phone_number}" does not have profile image!')
 
 
-def generate_rank_file(msg_store, locale, contacts, insighters, output):
+def generate_rank_file(msg_store, locale, contacts, insighters, output, sql_pushdown=False, cache_dir=None,
+                       state_file=None, index_joins=False, since=None, until=None, jids=None, exclude_groups=False,
+                       key=None, jobs=1, top=None):
     try:
         insighters_classes = [INSIGHTERS[i] for i in insighters]
     except KeyError as error:
@@ -447,17 +558,23 @@ def generate_rank_file(msg_store, locale, contacts, insighters, output):
             with open(locale_path, encoding='utf-8') as file:
                 locale_strings = json.load(file)
     
+    msg_store = open_msgstore(msg_store, key, index_joins, cache_dir)
+    if msg_store is None:
+        return
+
+    msgstore_cache = create_msgstore_cache(msg_store, cache_dir)
+
     logging.info('Loading contacts...')
     vcf_contact_manager = ContactManager.from_vcf(contacts)
-    contact_manager = ContactManager.from_msgtore_db(msg_store)
+    contact_manager = load_msgstore_contacts(msg_store, msgstore_cache)
     
     logging.info('Getting contact from vcf...')
+    vcf_contacts = join_contacts(contact_manager.get_users(), vcf_contact_manager.get_users())
     for contact in contact_manager.get_users():
-        for vcf_contact in vcf_contact_manager.get_users():
-            if utils.string_similarity(vcf_contact.jid, contact.jid) >= 0.95:
-                if not contact.display_name:
-                    contact_manager.update_contact_diplay_name(contact.jid, vcf_contact.display_name)
-                break
+        vcf_contact = vcf_contacts.get(contact.jid)
+        if vcf_contact:
+            if not contact.display_name:
+                contact_manager.update_contact_diplay_name(contact.jid, vcf_contact.display_name)
     
     insighter_manager = InsighterManager(contact_manager=contact_manager, group_by_name=True)
 
@@ -467,19 +584,10 @@ def generate_rank_file(msg_store, locale, contacts, insighters, output):
         format_ = insighter_strings.get('format')
         insighter_manager.add_insighter(insighter(title=title, format_=format_))
 
-    logging.info('Loading call logs...')
-    call_manager = CallManager.from_msgstore_db(msg_store)
-    
-    logging.info('Loading messages...')
-    message_manager = MessageManager.from_msgstore_db(msg_store)
-
-    logging.info('Applying messages in the insighters...')
-    for message in message_manager:
-        insighter_manager.update(message)
-
-    logging.info('Applying calls in the insighters...')
-    for call in call_manager:
-        insighter_manager.update(call)
+    msgstore_filter = create_msgstore_filter(since, until, jids, exclude_groups)
+    if not apply_msgstore_in_insighters(insighter_manager, msg_store, sql_pushdown, msgstore_cache, state_file,
+                                        msgstore_filter, jobs):
+        return
     
     result = dict()
 
@@ -488,7 +596,7 @@ def generate_rank_file(msg_store, locale, contacts, insighters, output):
             properties = dict()
             properties['title'] = insighter.title
             properties['rank'] = []
-            for rank_item in insighter.get_rank():
+            for rank_item in (insighter.get_rank() if top is None else insighter.top(top)):
                 contact = contact_manager.get(rank_item.jid)
                 properties['rank'].append({
                     'jid': rank_item.jid,
@@ -549,7 +657,10 @@ if __name__ == '__main__':
 
     image_parser = subparsers.add_parser('generate-image', help='Generate Insights image',
                                          formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    image_parser.add_argument('--msg-store', dest='msg_store', default='msgstore.db', help='WhatsApp database file path')
+    image_parser.add_argument('--msg-store', dest='msg_store', default='msgstore.db',
+                              help='WhatsApp database file path, it can also be an encrypted backup (.crypt12 or .crypt14)')
+    image_parser.add_argument('--key', dest='key', default=None,
+                              help='WhatsApp encrypt key file path, used to decrypt the backup in memory when it is encrypted')
     image_parser.add_argument('--locale', dest='locale', default='en_US', help='Output language texts')
     image_parser.add_argument('--profile-pictures-dir', dest='profile_pictures_dir', default='profile_pictures',
                               help='Directory to look for contact profile pictures. ' 
@@ -562,29 +673,92 @@ if __name__ == '__main__':
     image_parser.add_argument('--top-insighter', dest='top_insighter', default='GreatestMessagesAmountInsighter',
                               help='Insigther result to show the top three in the image')
     image_parser.add_argument('--output', dest='output', default='insights.png', help='Insights output image file')
+    image_parser.add_argument('--cache-dir', dest='cache_dir', default=None,
+                              help='Directory to keep the parsed WhatsApp database, reused while the database does not change')
+    image_parser.add_argument('--index-joins', dest='index_joins', default=False, action='store_true',
+                              help='Build the missing join indexes in a copy of the WhatsApp database, kept in the cache directory '
+                                   'when it is set')
+    image_parser.add_argument('--since', dest='since', type=datetime.fromisoformat, default=None,
+                              help='Only use the messages and calls sent at or after this date (e.g. 2021-01-01)')
+    image_parser.add_argument('--until', dest='until', type=datetime.fromisoformat, default=None,
+                              help='Only use the messages and calls sent before this date (e.g. 2022-01-01)')
+    image_parser.add_argument('--jids', nargs='+', dest='jids', default=None,
+                              help='Only use the messages and calls of these chats')
+    image_parser.add_argument('--exclude-groups', dest='exclude_groups', default=False, action='store_true',
+                              help='Do not read the messages and calls of groups')
+    image_parser.add_argument('--state', dest='state_file', default=None,
+                              help='File to keep the insighters state, next runs will only apply the new messages and calls. '
+                                   'It is also saved while the messages and calls are applied, an interrupted run resumes from it')
+    image_parser.add_argument('--sql-pushdown', dest='sql_pushdown', default=False, action='store_true',
+                              help='Compute the insighters that support it directly in the database')
+    image_parser.add_argument('--jobs', dest='jobs', type=int, default=1,
+                              help='Amount of processes computing the insighters when the database cache is used')
 
     video_parser = subparsers.add_parser('generate-video', help='Generate Chart Race video',
                                          formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    video_parser.add_argument('--msg-store', dest='msg_store', default='msgstore.db', help='WhatsApp database file path')
+    video_parser.add_argument('--msg-store', dest='msg_store', default='msgstore.db',
+                              help='WhatsApp database file path, it can also be an encrypted backup (.crypt12 or .crypt14)')
+    video_parser.add_argument('--key', dest='key', default=None,
+                              help='WhatsApp encrypt key file path, used to decrypt the backup in memory when it is encrypted')
     video_parser.add_argument('--locale', dest='locale', default='en_US', help='Output language texts')
     video_parser.add_argument('--profile-pictures-dir', dest='profile_pictures_dir', default='profile_pictures',
                               help='Directory to look for contact profile pictures. ' 
                                    'It will be used default profile picture when the program do not find')
     video_parser.add_argument('--contacts', dest='contacts', default='contacts.vcf', help='Contacts export file path')
     video_parser.add_argument('--output', dest='output', default='chart-race.mp4', help='Chart Race output video file')
+    video_parser.add_argument('--cache-dir', dest='cache_dir', default=None,
+                              help='Directory to keep the parsed WhatsApp database, reused while the database does not change')
+    video_parser.add_argument('--index-joins', dest='index_joins', default=False, action='store_true',
+                              help='Build the missing join indexes in a copy of the WhatsApp database, kept in the cache directory '
+                                   'when it is set')
+    video_parser.add_argument('--since', dest='since', type=datetime.fromisoformat, default=None,
+                              help='Only use the messages sent at or after this date (e.g. 2021-01-01)')
+    video_parser.add_argument('--until', dest='until', type=datetime.fromisoformat, default=None,
+                              help='Only use the messages sent before this date (e.g. 2022-01-01)')
+    video_parser.add_argument('--jids', nargs='+', dest='jids', default=None,
+                              help='Only use the messages of these chats')
+    video_parser.add_argument('--exclude-groups', dest='exclude_groups', default=False, action='store_true',
+                              help='Do not read the messages of groups')
     video_parser.add_argument('--exclude-no-display-name-contacts', default=False, action='store_true',
                               help='Not include contacts without display name')
     video_parser.add_argument('--from-export-chats', dest='export_chats_folder', default=None,
                               help='Folder text files containing messages exported from WhatsApp')
+    video_parser.add_argument('--jobs', dest='jobs', type=int, default=1,
+                              help='Amount of processes parsing the exported chats at the same time')
 
     rank_parser = subparsers.add_parser('generate-rank-file', help='Generate JSON file containing the rank of each insighter',
                                                   formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    rank_parser.add_argument('--msg-store', dest='msg_store', default='msgstore.db', help='WhatsApp database file path')
+    rank_parser.add_argument('--msg-store', dest='msg_store', default='msgstore.db',
+                             help='WhatsApp database file path, it can also be an encrypted backup (.crypt12 or .crypt14)')
+    rank_parser.add_argument('--key', dest='key', default=None,
+                             help='WhatsApp encrypt key file path, used to decrypt the backup in memory when it is encrypted')
     rank_parser.add_argument('--locale', dest='locale', default='en_US', help='Output language texts')
     rank_parser.add_argument('--contacts', dest='contacts', default='contacts.vcf', help='Contacts export file path')
     rank_parser.add_argument('--insighters', nargs='+', dest='insighters', choices=list(INSIGHTERS.keys()), 
                              default=list(INSIGHTERS.keys()))
     rank_parser.add_argument('--output', dest='output', default='rank.json', help='Rank output JSON file')
+    rank_parser.add_argument('--cache-dir', dest='cache_dir', default=None,
+                             help='Directory to keep the parsed WhatsApp database, reused while the database does not change')
+    rank_parser.add_argument('--index-joins', dest='index_joins', default=False, action='store_true',
+                             help='Build the missing join indexes in a copy of the WhatsApp database, kept in the cache directory '
+                                  'when it is set')
+    rank_parser.add_argument('--since', dest='since', type=datetime.fromisoformat, default=None,
+                             help='Only use the messages and calls sent at or after this date (e.g. 2021-01-01)')
+    rank_parser.add_argument('--until', dest='until', type=datetime.fromisoformat, default=None,
+                             help='Only use the messages and calls sent before this date (e.g. 2022-01-01)')
+    rank_parser.add_argument('--jids', nargs='+', dest='jids', default=None,
+                             help='Only use the messages and calls of these chats')
+    rank_parser.add_argument('--exclude-groups', dest='exclude_groups', default=False, action='store_true',
+                             help='Do not read the messages and calls of groups')
+    rank_parser.add_argument('--state', dest='state_file', default=None,
+                             help='File to keep the insighters state, next runs will only apply the new messages and calls. '
+                                  'It is also saved while the messages and calls are applied, an interrupted run resumes from it')
+    rank_parser.add_argument('--sql-pushdown', dest='sql_pushdown', default=False, action='store_true',
+                             help='Compute the insighters that support it directly in the database')
+    rank_parser.add_argument('--jobs', dest='jobs', type=int, default=1,
+                             help='Amount of processes computing the insighters when the database cache is used')
+    rank_parser.add_argument('--top', dest='top', type=int, default=None,
+                             help='Amount of contacts kept in the rank of each insighter, by default all of them')
 
     args = parser.parse_args()
 
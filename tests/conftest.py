@@ -0,0 +1,67 @@
+import sqlite3
+
+import pytest
+
+# libs.utils has to be imported before the other modules of libs, as done by main.py
+from libs import utils  # noqa: F401
+
+MSGSTORE_SCHEMA = '''
+CREATE TABLE jid(_id INTEGER PRIMARY KEY, user TEXT, server TEXT, raw_string TEXT);
+CREATE TABLE chat(_id INTEGER PRIMARY KEY, jid_row_id INTEGER);
+CREATE TABLE message(_id INTEGER PRIMARY KEY, chat_row_id INTEGER, from_me INTEGER, key_id TEXT, status INTEGER,
+                     text_data TEXT, timestamp INTEGER);
+CREATE TABLE message_media(message_row_id INTEGER PRIMARY KEY, mime_type TEXT, media_name TEXT, media_duration INTEGER);
+CREATE TABLE message_forwarded(message_row_id INTEGER PRIMARY KEY, forward_score INTEGER);
+CREATE TABLE message_quoted(message_row_id INTEGER PRIMARY KEY, chat_row_id INTEGER, from_me INTEGER, key_id TEXT,
+                            text_data TEXT, timestamp INTEGER);
+CREATE TABLE call_log(_id INTEGER PRIMARY KEY, jid_row_id INTEGER, from_me INTEGER, timestamp INTEGER,
+                      video_call INTEGER, duration INTEGER, call_result INTEGER);
+'''
+
+
+class Msgstore:
+    """
+    Minimal msgstore.db, with the tables and columns read by the program
+    """
+    def __init__(self, path):
+        self.path = str(path)
+        self._conn = sqlite3.connect(self.path)
+        self._conn.executescript(MSGSTORE_SCHEMA)
+
+    def get_chat(self, jid):
+        row = self._conn.execute('SELECT chat._id FROM chat INNER JOIN jid ON chat.jid_row_id = jid._id '
+                                 'WHERE jid.raw_string = ?', (jid,)).fetchone()
+        if row:
+            return row[0]
+        user, server = jid.split('@')
+        jid_row_id = self._conn.execute('INSERT INTO jid (user, server, raw_string) VALUES (?, ?, ?)',
+                                        (user, server, jid)).lastrowid
+        return self._conn.execute('INSERT INTO chat (jid_row_id) VALUES (?)', (jid_row_id,)).lastrowid
+
+    def add_message(self, jid, from_me, key_id, timestamp, text=None, mime_type=None, media_name=None,
+                    media_duration=None, quote=None):
+        """
+        :param quote: Jid, from_me and key_id of the quoted message
+        """
+        row_id = self._conn.execute('INSERT INTO message (chat_row_id, from_me, key_id, status, text_data, timestamp) '
+                                    'VALUES (?, ?, ?, 0, ?, ?)',
+                                    (self.get_chat(jid), int(from_me), key_id, text, timestamp)).lastrowid
+        if mime_type:
+            self._conn.execute('INSERT INTO message_media VALUES (?, ?, ?, ?)',
+                               (row_id, mime_type, media_name, media_duration))
+        if quote:
+            quote_jid, quote_from_me, quote_key_id = quote
+            self._conn.execute('INSERT INTO message_quoted VALUES (?, ?, ?, ?, NULL, ?)',
+                               (row_id, self.get_chat(quote_jid), int(quote_from_me), quote_key_id, timestamp))
+        self._conn.commit()
+        return row_id
+
+    def close(self):
+        self._conn.close()
+
+
+@pytest.fixture
+def msgstore(tmp_path):
+    msgstore = Msgstore(tmp_path / 'msgstore.db')
+    yield msgstore
+    msgstore.close()
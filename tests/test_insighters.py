@@ -0,0 +1,141 @@
+import os
+import sys
+import json
+import subprocess
+
+import pytest
+
+from libs.contacts import ContactManager
+from libs.insighters import InsighterManager, MessageInsighter, GreatestMessagesAmountInsighter
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GROUPED_JIDS = [f'55819000000{index}@s.whatsapp.net' for index in range(8)]
+
+# Apply a msgstore.db in GreatestMessagesAmountInsighter keeping its state, all the jids share the same display name.
+# The run is interrupted after the given amount of messages (0 to apply all of them), saving checkpoints meanwhile.
+STATE_RUN_SCRIPT = '''
+import os
+import sys
+import json
+
+from libs import utils
+from libs.contacts import ContactManager
+from libs.insighters import InsighterManager, MessageInsighter, GreatestMessagesAmountInsighter
+
+db_path, state_file, jids, stop_at = sys.argv[1], sys.argv[2], json.loads(sys.argv[3]), int(sys.argv[4])
+contact_manager = ContactManager()
+for jid in jids:
+    contact_manager.add_contact(jid, 'Alice')
+insighter_manager = InsighterManager(contact_manager, group_by_name=True)
+insighter_manager.add_insighter(GreatestMessagesAmountInsighter())
+if os.path.exists(state_file):
+    insighter_manager.load_state(state_file)
+if stop_at:
+    update_by_message = insighter_manager._update_by_message
+
+    def interrupted_update_by_message(message, insighters=None):
+        global stop_at
+        stop_at -= 1
+        if not stop_at:
+            sys.exit(1)
+        update_by_message(message, insighters)
+
+    insighter_manager._update_by_message = interrupted_update_by_message
+insighter_manager.update_from_msgstore_db(db_path, checkpoint_file=None if state_file == '-' else state_file,
+                                          checkpoint_interval=7)
+if state_file != '-':
+    insighter_manager.save_state(state_file)
+print(json.dumps({item.jid: item.value for item in insighter_manager.insighters[0].get_rank()}))
+'''
+
+
+def run_state_script(db_path, state_file, hash_seed, stop_at=0):
+    env = dict(os.environ, PYTHONHASHSEED=str(hash_seed))
+    result = subprocess.run([sys.executable, '-c', STATE_RUN_SCRIPT, db_path, state_file, json.dumps(GROUPED_JIDS),
+                             str(stop_at)], cwd=REPOSITORY_DIR, env=env, capture_output=True, text=True)
+    if stop_at:
+        assert result.returncode == 1
+        return None
+    assert result.returncode == 0, result.stderr
+    return json.loads(result.stdout)
+
+
+def add_messages(msgstore, start, end):
+    for index in range(start, end):
+        jid = GROUPED_JIDS[index % len(GROUPED_JIDS)]
+        msgstore.add_message(jid, index % 3 == 0, f'KEY{index}', 1600000000000 + index * 1000)
+
+
+@pytest.mark.parametrize('hash_seeds', [(0, 1), (1, 2), (7, 3), (42, 1000)])
+def test_grouped_jids_state_across_processes(msgstore, tmp_path, hash_seeds):
+    state_file = str(tmp_path / 'insighters.state')
+    add_messages(msgstore, 0, 40)
+    run_state_script(msgstore.path, state_file, hash_seeds[0])
+    add_messages(msgstore, 40, 100)
+
+    rank = run_state_script(msgstore.path, state_file, hash_seeds[1])
+
+    assert rank == {min(GROUPED_JIDS): 100}
+    assert rank == run_state_script(msgstore.path, '-', hash_seeds[1] + 1)
+
+
+@pytest.mark.parametrize('hash_seeds', [(0, 1), (5, 6), (42, 1000)])
+def test_grouped_jids_checkpoint_across_processes(msgstore, tmp_path, hash_seeds):
+    state_file = str(tmp_path / 'insighters.state')
+    add_messages(msgstore, 0, 100)
+    run_state_script(msgstore.path, state_file, hash_seeds[0], stop_at=60)
+    assert os.path.exists(state_file)
+
+    rank = run_state_script(msgstore.path, state_file, hash_seeds[1])
+
+    assert rank == {min(GROUPED_JIDS): 100}
+
+
+def test_load_state_with_other_grouped_jids(msgstore, tmp_path):
+    state_file = str(tmp_path / 'insighters.state')
+    add_messages(msgstore, 0, 10)
+
+    def create_insighter_manager(display_names):
+        contact_manager = ContactManager()
+        for jid, display_name in zip(GROUPED_JIDS, display_names):
+            contact_manager.add_contact(jid, display_name)
+        insighter_manager = InsighterManager(contact_manager, group_by_name=True)
+        insighter_manager.add_insighter(GreatestMessagesAmountInsighter())
+        return insighter_manager
+
+    insighter_manager = create_insighter_manager(['Alice'] * len(GROUPED_JIDS))
+    insighter_manager.update_from_msgstore_db(msgstore.path)
+    insighter_manager.save_state(state_file)
+
+    assert create_insighter_manager(['Alice'] * len(GROUPED_JIDS)).load_state(state_file)
+    with pytest.raises(ValueError):
+        create_insighter_manager(['Alice', 'Bob'] * (len(GROUPED_JIDS) // 2)).load_state(state_file)
+
+
+class GreatestLaughsAmountInsighter(MessageInsighter):
+    """
+    Insighter without get_required_fields, as the ones written outside of the project
+    """
+    def __init__(self):
+        super().__init__('Greatest laughs amount', None)
+
+    def is_valid_data(self, message):
+        return not message.from_me and message.data is not None and 'haha' in message.data
+
+    def handle_data(self, message):
+        current_value = self._rank[message.remote_jid].value if message.remote_jid in self._rank else 0
+        self._set_contact_rank_value(message.remote_jid, current_value + 1)
+
+
+def test_insighter_without_required_fields_reads_text(msgstore):
+    msgstore.add_message(GROUPED_JIDS[0], False, 'KEY0', 1600000000000, text='hahaha')
+    msgstore.add_message(GROUPED_JIDS[0], False, 'KEY1', 1600000001000, text='ok')
+    msgstore.add_message(GROUPED_JIDS[1], False, 'KEY2', 1600000002000, text='haha')
+    insighter_manager = InsighterManager(ContactManager())
+    insighter_manager.add_insighter(GreatestMessagesAmountInsighter())
+    insighter_manager.add_insighter(GreatestLaughsAmountInsighter())
+
+    insighter_manager.update_from_msgstore_db(msgstore.path)
+
+    rank = insighter_manager.insighters[1].get_rank()
+    assert {item.jid: item.value for item in rank} == {GROUPED_JIDS[0]: 1, GROUPED_JIDS[1]: 1}
@@ -0,0 +1,52 @@
+from libs.contacts import ContactManager
+from libs.messages import MessageManager, MessageStore
+from libs.insighters import InsighterManager, GreatestMyStatusAnsweredInsighter
+
+STATUS_JID = 'status@broadcast'
+FRIEND_JID = '5581900000001@s.whatsapp.net'
+OTHER_JID = '5581900000002@s.whatsapp.net'
+
+
+def add_status_answer(msgstore):
+    """
+    An answer to a status of mine whose key_id is also used by a message of another chat
+    """
+    msgstore.add_message(OTHER_JID, True, 'SHARED', 1600000000000, text='chat message')
+    msgstore.add_message(STATUS_JID, True, 'SHARED', 1600000001000, text='status')
+    msgstore.add_message(FRIEND_JID, False, 'ANSWER', 1600000002000, text='answer', quote=(STATUS_JID, True, 'SHARED'))
+
+
+def test_message_store_quote_key_includes_jid(msgstore):
+    add_status_answer(msgstore)
+
+    message_store = MessageStore.from_msgstore_db(msgstore.path, load_text=True)
+    answer = next(message for message in message_store if message.key_id == 'ANSWER')
+
+    assert answer.quote_message.remote_jid == STATUS_JID
+    assert answer.quote_message.data == 'status'
+
+
+def test_message_manager_quote_key_includes_jid(msgstore):
+    add_status_answer(msgstore)
+
+    message_manager = MessageManager.from_msgstore_db(msgstore.path)
+    answer = next(message for message in message_manager if message.key_id == 'ANSWER')
+
+    assert answer.quote_message.remote_jid == STATUS_JID
+    assert answer.quote_message.data == 'status'
+
+
+def test_status_answered_store_matches_stream(msgstore):
+    add_status_answer(msgstore)
+    contact_manager = ContactManager()
+    ranks = []
+    for messages in (MessageStore.from_msgstore_db(msgstore.path), None):
+        insighter_manager = InsighterManager(contact_manager)
+        insighter_manager.add_insighter(GreatestMyStatusAnsweredInsighter())
+        if messages is None:
+            insighter_manager.update_from_msgstore_db(msgstore.path)
+        else:
+            insighter_manager.update_messages(messages)
+        ranks.append({item.jid: item.value for item in insighter_manager.insighters[0].get_rank()})
+
+    assert ranks[0] == ranks[1] == {FRIEND_JID: 1}